@@ -1,16 +1,38 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, Response
 from flask import Flask, send_from_directory
+import math
 import os
+import sys
 from flask_cors import CORS
-import pandas as pd
-import numpy as np
-import io
-from datetime import datetime
-from pymongo import MongoClient
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
 import uuid
-import re
+import threading
+import time
 from bson import ObjectId
 
+# The shared pipeline and server modules live at the repository root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from hmpi_pipeline import (
+    STANDARD_PROFILES, STATS_VERSION, DatasetStats, build_geojson_features, dataset_fields,
+    excel_metadata_counters, export_csv, export_gzip, export_ndjson, export_parquet,
+    features_to_columns, load_file, metal_column_cache_stats, pipeline_params_from_features,
+    run_append_pipeline, run_lean_pipeline, scan_csv_statistics, stats_from_features, timed_stage,
+)
+import hmpi_server as server
+from hmpi_server import (
+    CLUSTER_MAX_ZOOM, EXPORT_FORMATS, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, TILE_MAX_ZOOM,
+    bbox_geometry, check_feature_format, cluster_cache_counters, columns_hmpi_profiles,
+    commit_append, feature_response, feature_source_id, file_cache_key, get_cached_result,
+    get_cluster_index, iter_feature_batches, load_features, load_hmpi_values, mongo_pool,
+    parse_floats, process_upload_batch, render_metrics, requested_standards, result_cache_counters,
+    standard_info, standards_fields, store_batch_datasets, store_cached_result, store_dataset,
+    store_features, stored_hmpi_profiles, stream_process_response, submit_process_job, tile_bounds,
+    upload_reference, valid_lonlat, worker_status,
+)
+
 # Get the directory where this script is located
 basedir = os.path.abspath(os.path.dirname(__file__))
 # Static folder path - look for dist folder relative to this file or in parent directory
@@ -25,24 +47,8 @@ app = Flask(
 )
 CORS(app)
 
-# MongoDB connection - use environment variable or default to localhost
-MONGODB_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017/")
-client = MongoClient(MONGODB_URI)
-db = client['heavy_metal_db']
-samples_collection = db['samples']
-
-METAL_KEYWORDS = {
-    'Mercury': ['hg', 'mercury', 'hg_conc', 'mercury_conc', 'merc'],
-    'Lead': ['pb', 'lead', 'pb_conc', 'lead_conc'],
-    'Cadmium': ['cd', 'cadmium', 'cd_conc'],
-    'Arsenic': ['as', 'arsenic', 'as_conc'],
-    'Chromium': ['cr', 'chromium', 'cr_conc'],
-    'Nickel': ['ni', 'nickel', 'ni_conc'],
-    'Copper': ['cu', 'copper', 'cu_conc'],
-    'Zinc': ['zn', 'zinc', 'zn_conc'],
-    'Iron': ['fe', 'iron', 'fe_conc'],
-    'Manganese': ['mn', 'manganese', 'mn_conc']
-    }
+server.init_app(app)
+
 
 @app.route("/")
 def serve_react():
@@ -62,136 +68,149 @@ def serve_static(path):
     return jsonify({"error": "Static files not found"}), 404
 
 
-def allowed_file(filename):
-    return filename.lower().endswith(('.csv','.xls','.xlsx'))
-
-def detect_metal_columns(df):
-    metal_cols = {}
-    for metal, keywords in METAL_KEYWORDS.items():
-        found_cols = []
-        for col in df.columns:
-            col_clean = re.sub(r'[^a-z0-9]', '', col.lower())
-            if any(re.sub(r'[^a-z0-9]', '', kw.lower()) in col_clean for kw in keywords):
-                found_cols.append(col)
-        if found_cols:
-            metal_cols[metal] = found_cols
-    return metal_cols
-
-def merge_metal_columns(df, metal_cols):
-    merged_df = df.copy()
-    merged_cols = {}
-    for metal, cols in metal_cols.items():
-        # Skip metals with no columns detected
-        if not cols:
-            continue
-        
-        if len(cols) > 1:
-            merged_df[metal] = merged_df[cols].sum(axis=1)
-        else:
-            merged_df[metal] = merged_df[cols[0]]
-        merged_cols[metal] = metal  # only metals present in df
-    return merged_df, merged_cols
-
-
-def validate_geo_columns(df):
-    geo_cols = {}
-    for col in ['Location', 'Latitude', 'Longitude']:
-        matches = [c for c in df.columns if col.lower() in c.lower()]
-        geo_cols[col] = matches[0] if matches else None
-    return geo_cols
-
-def handle_missing_values(df, metal_cols, strategy='half', detection_limits=None):
-    df_clean = df.copy()
-    for metal in metal_cols:
-        if metal not in df_clean.columns:
-            continue
-        if strategy=='half':
-            fill_val = 0.5*df_clean[metal].min() if detection_limits is None else 0.5*detection_limits.get(metal,0)
-            df_clean[metal] = df_clean[metal].fillna(fill_val)
-
-        elif strategy=='zero':
-            df_clean[metal].fillna(0, inplace=True)
-        elif strategy=='mean':
-            df_clean[metal].fillna(df_clean[metal].mean(), inplace=True)
-        elif strategy=='median':
-            df_clean[metal].fillna(df_clean[metal].median(), inplace=True)
-        elif strategy=='none':
-            df_clean[metal] = df_clean[metal].astype(float)
-    return df_clean
-
-STANDARD_LIMITS = {
-    "Mercury": 0.001,
-    "Lead": 0.01,
-    "Cadmium": 0.003,
-    "Arsenic": 0.01,
-    "Chromium": 0.05,
-    "Nickel": 0.02,
-    "Copper": 2.0,
-    "Zinc": 3.0,
-    "Iron": 0.3,
-    "Manganese": 0.1
-}
-
 # Legacy constants kept for compatibility but no longer drive access rules.
 UPLOADS_LIMIT = 5
 FREE_ROW_LIMIT = 20
-def compute_hmpi_vectorized(df, metal_cols):
-    """
-    Compute HMPI for a dataframe with metal concentrations.
-    Uranium is included in HMPI calculation only if present in DataFrame.
-    """
-    df_hmpi = df.copy()
 
-    # Only consider metals present in DataFrame and STANDARD_LIMITS
-    valid_metals = {metal: col for metal, col in metal_cols.items() if metal in STANDARD_LIMITS and col in df_hmpi.columns}
 
-    if not valid_metals:
-        df_hmpi["HMPI"] = np.nan
-        return df_hmpi
+# Largest page /geojson/<file_id> returns when called with ?limit=
+GEOJSON_MAX_PAGE_SIZE = int(os.environ.get("GEOJSON_MAX_PAGE_SIZE", 50000))
+
+# /history/<user_id> pages and the summary fields it returns per upload
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get("HISTORY_MAX_PAGE_SIZE", 500))
+HISTORY_FIELDS = {"file_name": 1, "created_at": 1, "user_id": 1, "row_count": 1,
+                  "feature_count": 1, "hmpi_stats": 1}
+# Newest first on (created_at, _id), served by the uploads index
+HISTORY_SORT = [("created_at", -1), ("_id", -1)]
+
+# Most files accepted by one /upload/batch request
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", 50))
+
+# Seconds after which a dataset's append lock is taken to be left by a crashed worker
+APPEND_LOCK_TIMEOUT = int(os.environ.get("APPEND_LOCK_TIMEOUT", 600))
+
+
+# Per-worker cache of user accounting state. Entries expire after
+# USER_CACHE_TTL seconds and are dropped whenever this worker changes the
+# user; with USER_CACHE_CHANGE_STREAM=1 (replica sets only) changes made by
+# other workers drop them too instead of waiting for the TTL. At most
+# USER_CACHE_MAX_ENTRIES users are kept.
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 10))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get("USER_CACHE_MAX_ENTRIES", 10000))
+USER_CACHE_CHANGE_STREAM = os.environ.get("USER_CACHE_CHANGE_STREAM") == "1"
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+_user_watch_started = False
+user_cache_counters = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+
+def invalidate_user(user_obj_id):
+    with _user_cache_lock:
+        if _user_cache.pop(user_obj_id, None) is not None:
+            user_cache_counters["invalidations"] += 1
+
+
+def cache_user(user_obj_id, user):
+    """Cache a freshly read user, dropping expired entries and, past USER_CACHE_MAX_ENTRIES, the oldest"""
+    now = time.monotonic()
+    entry = {"user": user, "latest_row_count": None, "expires_at": now + USER_CACHE_TTL}
+    with _user_cache_lock:
+        # Entries stay in insertion order, which is also expiry order, so
+        # the expired ones and the first to be evicted are all at the front
+        _user_cache.pop(user_obj_id, None)
+        while _user_cache and (next(iter(_user_cache.values()))["expires_at"] <= now
+                               or len(_user_cache) >= USER_CACHE_MAX_ENTRIES):
+            _user_cache.popitem(last=False)
+            user_cache_counters["evictions"] += 1
+        _user_cache[user_obj_id] = entry
+    return entry
+
+
+def watch_user_changes():
+    """Drop cached users changed by any worker, for as long as the change stream lasts"""
+    try:
+        with server.db.users.watch([{"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}}]) as stream:
+            for change in stream:
+                invalidate_user(change["documentKey"]["_id"])
+    except Exception:
+        # e.g. a standalone server without change streams: the TTL still applies
+        import traceback
+        traceback.print_exc()
 
-    Wi_total = sum(1 / STANDARD_LIMITS[metal] for metal in valid_metals)
 
-    for metal, col in valid_metals.items():
-        Si = STANDARD_LIMITS[metal]
-        Ci = df_hmpi[col].copy()
+def start_user_watch():
+    global _user_watch_started
+    with _user_cache_lock:
+        if _user_watch_started:
+            return
+        _user_watch_started = True
+    threading.Thread(target=watch_user_changes, name="user-cache-watch", daemon=True).start()
+
+
+@timed_stage("user")
+def cached_user_entry(user_obj_id):
+    """The user's cache entry, reading the user from MongoDB on a miss; None if unknown"""
+    if USER_CACHE_CHANGE_STREAM:
+        start_user_watch()
+    now = time.monotonic()
+    with _user_cache_lock:
+        entry = _user_cache.get(user_obj_id)
+        if entry is not None and entry["expires_at"] > now:
+            user_cache_counters["hits"] += 1
+            return entry
+        user_cache_counters["misses"] += 1
+
+    user = server.db.users.find_one({"_id": user_obj_id})
+    if not user:
+        return None
+    return cache_user(user_obj_id, user)
+
 
-        # Convert μg/L → mg/L if Ci is much higher than standard (heuristic)
-        if (Ci > 100 * Si).any():
-            Ci = Ci / 1000
+def latest_upload_row_count(user_obj_id):
+    """row_count of the user's most recent upload, cached alongside the user"""
+    with _user_cache_lock:
+        entry = _user_cache.get(user_obj_id)
+    if entry is not None and entry["latest_row_count"] is not None:
+        return entry["latest_row_count"]
 
-        Qi = (Ci / Si) * 100
-        Wi = (1 / Si) / Wi_total
+    last_upload = server.db.uploads.find_one(
+        {"user_id": user_obj_id},
+        {"row_count": 1},
+        sort=[("created_at", -1), ("_id", -1)]
+    )
+    row_count = last_upload.get("row_count", 0) if last_upload else 0
+    if entry is not None:
+        entry["latest_row_count"] = row_count
+    return row_count
 
-        df_hmpi[f"{metal}_Qi"] = Qi
-        df_hmpi[f"{metal}_Wi"] = Wi
-        df_hmpi[f"{metal}_SIi"] = Qi * Wi
 
-    # HMPI = sum of weighted indices (metals detected in dataset)
-    si_columns = [f"{metal}_SIi" for metal in valid_metals]
-    df_hmpi["HMPI"] = df_hmpi[si_columns].sum(axis=1)
+@timed_stage("accounting")
+def record_uploads(user_obj_id, n=1):
+    """
+    Count n new uploads for the user with one atomic $inc, so concurrent
+    uploads from any worker never lose an increment, and refresh this
+    worker's cache entry from the updated document.
+    """
+    user = server.db.users.find_one_and_update(
+        {"_id": user_obj_id},
+        {"$inc": {"upload_count": n}},
+        return_document=ReturnDocument.AFTER
+    )
+    if user is not None:
+        # The latest upload may belong to a concurrent request, so it is re-read lazily
+        cache_user(user_obj_id, user)
+    return user
 
-    return df_hmpi
 
-def load_file(file):
-    """Reads CSV or Excel into pandas DataFrame"""
-    if file.filename.lower().endswith('.csv'):
-        return pd.read_csv(file)
-    elif file.filename.lower().endswith(('.xls', '.xlsx')):
-        return pd.read_excel(file)
-    else:
-        raise ValueError("Unsupported file format")
+def user_cache_stats():
+    lookups = user_cache_counters["hits"] + user_cache_counters["misses"]
+    return {
+        **user_cache_counters,
+        "hit_rate": user_cache_counters["hits"] / lookups if lookups else None,
+        "size": len(_user_cache),
+    }
 
-def preprocess_dataframe(df):
-    metal_cols = detect_metal_columns(df)      
-    df_merged, merged_cols = merge_metal_columns(df, metal_cols)  
-    
-    if 'Uranium' in merged_cols and 'Uranium' not in df_merged.columns:
-        merged_cols.pop('Uranium')
-    
-    df_clean = handle_missing_values(df_merged, merged_cols, strategy="half")  
-    geo_cols = validate_geo_columns(df_clean)  
-    return df_clean, merged_cols
-    
 
 def get_user_and_usage():
     """
@@ -207,10 +226,11 @@ def get_user_and_usage():
     except Exception:
         return None, jsonify({"error": "Invalid user_id format"}), 400
 
-    user = db.users.find_one({"_id": user_obj_id})
-    if not user:
+    entry = cached_user_entry(user_obj_id)
+    if entry is None:
         return None, jsonify({"error": "User not found"}), 404
 
+    user = entry["user"]
     upload_count = user.get("upload_count", 0)
     token_balance = user.get("token_balance", 0)
     return (user, upload_count, token_balance), None, None
@@ -266,22 +286,18 @@ def build_entitlement_state(row_count, token_balance):
     }
 
 
-def prepare_geojson(df, geo_cols):
-    if geo_cols.get('Latitude') and geo_cols.get('Longitude'):
-        df_geo = df.copy()
-        df_geo['geometry'] = df_geo.apply(
-            lambda row: {"type": "Point", "coordinates": [row[geo_cols['Longitude']], row[geo_cols['Latitude']]]}
-            if pd.notna(row[geo_cols['Longitude']]) and pd.notna(row[geo_cols['Latitude']])
-            else None, axis=1)
-        return df_geo
-    return None
-
-
 @app.route("/upload", methods=["POST"])
 def upload_file():
     if "file" not in request.files:
         return jsonify({"error": "No file uploaded"}), 400
+    bad_format = check_feature_format()
+    if bad_format:
+        return bad_format
+    standards, bad_standards = requested_standards()
+    if bad_standards:
+        return bad_standards
     file = request.files["file"]
+    sheet = request.values.get("sheet")
 
     try:
         # Resolve user and accounting state
@@ -290,57 +306,110 @@ def upload_file():
             return err_resp, status
         user, upload_count, token_balance = user_ctx
 
-        # Load file and determine row count
-        df = load_file(file)
-        row_count = len(df)
-
-        # Run HMPI analysis pipeline (always free)
-        df_clean, merged_cols = preprocess_dataframe(df)
-        df_hmpi = compute_hmpi_vectorized(df_clean, merged_cols)
-
-        valid_metals_for_geo = [m for m in merged_cols if m in df_hmpi.columns]
-
-        # Build GeoJSON features
-        features = []
-        for _, row in df_hmpi.iterrows():
-            metal_conc = {m: row[m] for m in valid_metals_for_geo if pd.notna(row[m])}
-            latlon_flag = pd.notna(row.get("Latitude")) and pd.notna(row.get("Longitude"))
-
-            features.append({
-                "Sample_ID": row.get("Sample_ID", str(uuid.uuid4())),
-                "no_of_metals": len(metal_conc),
-                "all_metal_conc": metal_conc,
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": [row.get("Longitude"), row.get("Latitude")]
-                },
-                "latitudeandlongitudepresent": latlon_flag,
-                "HMPI": row.get("HMPI", None)
-            })
-
-        # Insert into uploads collection
+        # Re-uploads of the same file reuse the stored result
+        cache_key = file_cache_key(file, sheet=sheet)
+        dataset = get_cached_result(cache_key)
+        if dataset is not None:
+            features = load_features(dataset)
+            row_count = dataset["row_count"]
+            by_standard = stored_hmpi_profiles(dataset, features, standards) if standards else []
+        else:
+            # Load file and determine row count
+            df = load_file(file, sheet)
+            row_count = len(df)
+
+            # Run HMPI analysis pipeline (always free)
+            df_hmpi, merged_cols, params = run_lean_pipeline(df, standards=standards, return_params=True)
+            by_standard = [df_hmpi[f"HMPI_{s}"] for s in standards]
+
+            # Build GeoJSON features
+            features = build_geojson_features(df_hmpi, merged_cols)
+            dataset = store_dataset(cache_key, {
+                "user_id": user["_id"],
+                "row_count": row_count,
+                **dataset_fields(df_hmpi, merged_cols, params),
+            }, features)
+
+        # Insert into uploads collection, pointing at the stored features
         upload_doc = {
             "file_name": file.filename,
             "created_at": datetime.utcnow(),
-            "GeoJSON": features,
             "user_id": user["_id"],
             "row_count": row_count,
         }
-        db.uploads.insert_one(upload_doc)
+        upload_id = server.db.uploads.insert_one(upload_reference(upload_doc, dataset)).inserted_id
 
         # Update user accounting: increment upload count only (HMPI is free)
-        new_upload_count = upload_count + 1
-        db.users.update_one(
-            {"_id": user["_id"]},
-            {"$set": {"upload_count": new_upload_count}}
-        )
+        record_uploads(user["_id"])
 
         entitlement_payload = build_entitlement_state(row_count, token_balance)
 
-        return jsonify({
+        fields = {
             "msg": "Upload saved successfully",
             "file_name": file.filename,
-            "GeoJSON": features,
+            "upload_id": str(upload_id),
+            "entitlement_state": entitlement_payload["entitlement_state"],
+            "billing_state": entitlement_payload["billing_state"],
+            "ui_state": entitlement_payload["ui_state"],
+        }
+        if standards:
+            fields.update(standards_fields(standards, by_standard))
+        return feature_response(features, fields, 201)
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/upload/batch", methods=["POST"])
+def upload_batch():
+    files = request.files.getlist("files")
+    if not files:
+        return jsonify({"error": "No files uploaded"}), 400
+    if len(files) > BATCH_MAX_FILES:
+        return jsonify({"error": f"At most {BATCH_MAX_FILES} files per batch"}), 400
+    standards, bad_standards = requested_standards()
+    if bad_standards:
+        return bad_standards
+
+    try:
+        # Resolve user and accounting state once for the whole batch
+        user_ctx, err_resp, status = get_user_and_usage()
+        if err_resp is not None:
+            return err_resp, status
+        user, upload_count, token_balance = user_ctx
+
+        results = process_upload_batch(files, request.values.get("sheet"))
+        if results is None:
+            return jsonify({"error": "Too many jobs queued, retry later"}), 503, {"Retry-After": "5"}
+        saved = [r for r in results if "error" not in r]
+
+        # New datasets are stored once; then one insert for every upload in the batch
+        store_batch_datasets(saved, {"user_id": user["_id"]})
+        if standards:
+            for r in saved:
+                r.update(standards_fields(standards, stored_hmpi_profiles(r["dataset"], r["GeoJSON"], standards)))
+        now = datetime.utcnow()
+        # The dataset is referenced, not sent: /stats/<upload_id> serves the stats
+        upload_docs = [
+            upload_reference({"file_name": r["file_name"], "created_at": now, "user_id": user["_id"],
+                              "row_count": r["row_count"]}, r.pop("dataset"))
+            for r in saved
+        ]
+        upload_ids = server.db.uploads.insert_many(upload_docs).inserted_ids if upload_docs else []
+        for r, upload_id in zip(saved, upload_ids):
+            r["upload_id"] = str(upload_id)
+
+        # One accounting update for the whole batch
+        if saved:
+            record_uploads(user["_id"], len(saved))
+
+        # Entitlements follow the most recent dataset, as in /permissions
+        entitlement_payload = build_entitlement_state(saved[-1]["row_count"] if saved else 0, token_balance)
+
+        return jsonify({
+            "msg": f"{len(saved)} of {len(results)} uploads saved",
+            "results": results,
             "entitlement_state": entitlement_payload["entitlement_state"],
             "billing_state": entitlement_payload["billing_state"],
             "ui_state": entitlement_payload["ui_state"],
@@ -353,25 +422,61 @@ def upload_file():
 
 @app.route("/history/<user_id>", methods=["GET"])
 def user_history(user_id):
-    pipeline = [
-        {"$match": {"user_id": ObjectId(user_id)}},
-        {"$lookup": {
-            "from": "users",              
-            "localField": "user_id",      # field in uploads
-            "foreignField": "_id",        # field in users
-            "as": "user_info"
-        }},
-        {"$unwind": "$user_info"}  # flatten array so user_info is a dict
-    ]
-
-    uploads = list(db.uploads.aggregate(pipeline))
-    # convert ObjectId to string for JSON
+    """
+    Upload summaries for a user, newest first. Pages with ?limit=N and
+    ?before=<upload_id>, the `next` cursor of the previous page.
+    """
+    if not ObjectId.is_valid(user_id):
+        return jsonify({"error": "Invalid user_id"}), 400
+    user = server.db.users.find_one({"_id": ObjectId(user_id)})
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    limit = request.args.get("limit", default=HISTORY_PAGE_SIZE, type=int)
+    if limit <= 0:
+        return jsonify({"error": "limit must be positive"}), 400
+    limit = min(limit, HISTORY_MAX_PAGE_SIZE)
+
+    cursor_doc = None
+    before = request.args.get("before")
+    if before:
+        cursor_doc = ObjectId.is_valid(before) and server.db.uploads.find_one(
+            {"_id": ObjectId(before), "user_id": ObjectId(user_id)}, {"created_at": 1})
+        if not cursor_doc:
+            return jsonify({"error": "Invalid before cursor"}), 400
+
+    uploads = list(
+        server.db.uploads.find(history_query(ObjectId(user_id), cursor_doc), HISTORY_FIELDS)
+        .sort(HISTORY_SORT)
+        .limit(limit + 1)
+    )
+    return jsonify(history_payload(user, uploads, limit))
+
+
+def history_query(user_obj_id, cursor_doc=None):
+    """Uploads filter for one /history page: the user's uploads older than `cursor_doc`"""
+    query = {"user_id": user_obj_id}
+    if cursor_doc:
+        query["$or"] = [
+            {"created_at": {"$lt": cursor_doc["created_at"]}},
+            {"created_at": cursor_doc["created_at"], "_id": {"$lt": cursor_doc["_id"]}},
+        ]
+    return query
+
+
+def history_payload(user, uploads, limit):
+    """The /history body from the user and up to limit + 1 uploads in HISTORY_SORT order"""
+    user["_id"] = str(user["_id"])
+    has_more = len(uploads) > limit
+    uploads = uploads[:limit]
     for u in uploads:
         u["_id"] = str(u["_id"])
         u["user_id"] = str(u["user_id"])
-        u["user_info"]["_id"] = str(u["user_info"]["_id"])
-
-    return jsonify(uploads)
+    return {
+        "user": user,
+        "uploads": uploads,
+        "next": uploads[-1]["_id"] if has_more else None,
+    }
 
 
 @app.route("/register", methods=["POST"])
@@ -386,13 +491,13 @@ def register_user():
         "upload_count": 0,
         "token_balance": 0,
     }
-    result = db.users.insert_one(user_doc)
+    result = server.db.users.insert_one(user_doc)
 
     return jsonify({"msg": "User registered", "user_id": str(result.inserted_id)}), 201
 
 @app.route("/user/<user_id>", methods=["GET"])
 def get_user(user_id):
-    user = db.users.find_one({"_id": ObjectId(user_id)})
+    user = server.db.users.find_one({"_id": ObjectId(user_id)})
     if not user:
         return jsonify({"error": "User not found"}), 404
     
@@ -414,12 +519,8 @@ def get_permissions():
         return err_resp, status
     user, upload_count, token_balance = user_ctx
 
-    # Determine the "current" dataset as the most recent upload for this user
-    last_upload = db.uploads.find_one(
-        {"user_id": user["_id"]},
-        sort=[("created_at", -1)]
-    )
-    row_count = last_upload.get("row_count", 0) if last_upload else 0
+    # The "current" dataset is the most recent upload for this user
+    row_count = latest_upload_row_count(user["_id"])
 
     payload = build_entitlement_state(row_count, token_balance)
     return jsonify(payload)
@@ -428,8 +529,15 @@ def get_permissions():
 def process_file():
     if "file" not in request.files:
         return jsonify({"error": "No file uploaded"}), 400
+    bad_format = check_feature_format()
+    if bad_format:
+        return bad_format
+    standards, bad_standards = requested_standards()
+    if bad_standards:
+        return bad_standards
 
     file = request.files["file"]
+    sheet = request.values.get("sheet")
     try:
         # Resolve user and accounting state
         user_ctx, err_resp, status = get_user_and_usage()
@@ -437,50 +545,149 @@ def process_file():
             return err_resp, status
         user, upload_count, token_balance = user_ctx
 
-        # Load file
-        df = load_file(file)
-        row_count = len(df)
-
-        # Run HMPI pipeline (always free)
-        df_clean, merged_cols = preprocess_dataframe(df)
-        df_hmpi = compute_hmpi_vectorized(df_clean, merged_cols)
-
-        # Only consider metals actually present in the DataFrame
-        valid_metals_for_geo = [m for m in merged_cols if m in df_hmpi.columns]
-
-        # Build GeoJSON features
-        features = []
-        for _, row in df_hmpi.iterrows():
-            metal_conc = {m: row[m] for m in valid_metals_for_geo if pd.notna(row[m])}
-            latlon_flag = pd.notna(row.get("Latitude")) and pd.notna(row.get("Longitude"))
-
-            features.append({
-                "Sample_ID": row.get("Sample_ID", str(uuid.uuid4())),
-                "no_of_metals": len(metal_conc),
-                "all_metal_conc": metal_conc,
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": [row.get("Longitude"), row.get("Latitude")]
-                },
-                "latitudeandlongitudepresent": latlon_flag,
-                "HMPI": row.get("HMPI", None)
-            })
-
-        # Save to samples collection
-        doc_id = str(uuid.uuid4())
-        samples_collection.insert_one({
-            "_id": doc_id,
-            "GeoJSON": features,
-            "created_at": datetime.utcnow(),
-            "user_id": user["_id"],
-            "row_count": row_count,
-        })
+        # Stream large CSVs through the pipeline chunk by chunk
+        if request.args.get("stream") == "1" and file.filename.lower().endswith(".csv"):
+            if request.args.get("format", "geojson") != "geojson":
+                return jsonify({"error": "stream=1 only returns format=geojson"}), 400
+            if standards:
+                return jsonify({"error": "standards= is not supported with stream=1, "
+                                         "fetch them from /hmpi/<file_id> afterwards"}), 400
+            stats = scan_csv_statistics(file)
+            row_count = stats["row_count"]
+            return stream_process_response(
+                file,
+                stats,
+                doc_fields={"user_id": user["_id"], "row_count": row_count},
+                extra_payload=build_entitlement_state(row_count, token_balance),
+            )
+
+        # Hand the pipeline to the background job pool
+        if request.args.get("async") == "1":
+            job_id = submit_process_job(
+                file,
+                doc_fields={"user_id": user["_id"]},
+                job_fields={"user_id": user["_id"], "token_balance": token_balance, "standards": standards},
+                sheet=sheet,
+            )
+            if job_id is None:
+                return jsonify({"error": "Too many jobs queued, retry later"}), 503, {"Retry-After": "5"}
+            return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
+        # Re-uploads of the same file return the stored result
+        cache_key = file_cache_key(file, sheet=sheet)
+        cached = get_cached_result(cache_key)
+        if cached is not None:
+            doc_id = cached["_id"]
+            features = load_features(cached)
+            row_count = cached["row_count"]
+            by_standard = stored_hmpi_profiles(cached, features, standards) if standards else []
+        else:
+            # Load file
+            df = load_file(file, sheet)
+            row_count = len(df)
+
+            # Run HMPI pipeline (always free)
+            df_hmpi, merged_cols, params = run_lean_pipeline(df, standards=standards, return_params=True)
+            by_standard = [df_hmpi[f"HMPI_{s}"] for s in standards]
+
+            # Build GeoJSON features
+            features = build_geojson_features(df_hmpi, merged_cols)
+
+            # Save to samples collection
+            doc_id = str(uuid.uuid4())
+            store_features(server.samples_collection, {
+                "_id": doc_id,
+                "created_at": datetime.utcnow(),
+                "user_id": user["_id"],
+                "row_count": row_count,
+                **dataset_fields(df_hmpi, merged_cols, params),
+            }, features)
+            store_cached_result(cache_key, doc_id, row_count)
 
         entitlement_payload = build_entitlement_state(row_count, token_balance)
 
-        return jsonify({
+        fields = {
             "file_id": doc_id,
-            "GeoJSON": features,
+            "entitlement_state": entitlement_payload["entitlement_state"],
+            "billing_state": entitlement_payload["billing_state"],
+            "ui_state": entitlement_payload["ui_state"],
+        }
+        if standards:
+            fields.update(standards_fields(standards, by_standard))
+        return feature_response(features, fields)
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/datasets/<file_id>/append", methods=["POST"])
+def append_to_dataset(file_id):
+    if "file" not in request.files:
+        return jsonify({"error": "No file uploaded"}), 400
+    bad_format = check_feature_format()
+    if bad_format:
+        return bad_format
+    file = request.files["file"]
+    sheet = request.values.get("sheet")
+
+    # Resolve user and accounting state
+    user_ctx, err_resp, status = get_user_and_usage()
+    if err_resp is not None:
+        return err_resp, status
+    user, upload_count, token_balance = user_ctx
+
+    # One append per dataset at a time, each placing its rows after feature_count
+    now = datetime.utcnow()
+    doc = server.samples_collection.find_one_and_update(
+        {"_id": file_id, "$or": [
+            {"append_started_at": None},
+            {"append_started_at": {"$lt": now - timedelta(seconds=APPEND_LOCK_TIMEOUT)}},
+        ]},
+        {"$set": {"append_started_at": now}},
+        projection={"GeoJSON": 0},
+    )
+    if doc is None:
+        if server.samples_collection.count_documents({"_id": file_id}, limit=1):
+            return jsonify({"error": "Another append to this dataset is in progress"}), 409, {"Retry-After": "5"}
+        return jsonify({"error": "Dataset not found"}), 404
+
+    try:
+        if "chunk_size" not in doc:
+            return jsonify({"error": "Dataset predates chunked storage, process the file again to append to it"}), 409
+        if doc.get("user_id") not in (None, user["_id"]) and not doc.get("shared"):
+            return jsonify({"error": "Dataset belongs to another user"}), 403
+
+        df = load_file(file, sheet)
+        count = doc["feature_count"]
+        params = doc.get("pipeline_params") or pipeline_params_from_features(load_features(doc, 0, count))
+        df_hmpi, merged_cols, params = run_append_pipeline(df, params)
+        features = build_geojson_features(df_hmpi, merged_cols)
+
+        # Counts and per-metal sums carry over; percentiles and the
+        # histogram are rebuilt from the stored HMPI column
+        stats = doc.get("stats")
+        if stats and stats.get("version") == STATS_VERSION:
+            summary = DatasetStats.resume(stats, load_hmpi_values(doc), params["convert_units"])
+            stats = summary.add(df_hmpi, merged_cols).result()
+        else:
+            stats = stats_from_features(load_features(doc, 0, count) + features)
+
+        # A dataset other clients also hold (result cache hits) is copied, not changed
+        stored_id = commit_append(doc, features, {
+            "feature_count": count + len(features),
+            "hmpi_stats": {key: stats["hmpi"][key] for key in ("count", "min", "max", "mean")},
+            "stats": stats,
+            "pipeline_params": params,
+            "updated_at": now,
+        }, len(df), {"user_id": user["_id"]})
+
+        entitlement_payload = build_entitlement_state(doc.get("row_count", count) + len(df), token_balance)
+        return feature_response(features, {
+            "file_id": stored_id,
+            "appended": len(features),
+            "total": count + len(features),
             "entitlement_state": entitlement_payload["entitlement_state"],
             "billing_state": entitlement_payload["billing_state"],
             "ui_state": entitlement_payload["ui_state"],
@@ -490,29 +697,331 @@ def process_file():
         import traceback
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
+    finally:
+        # Only release our own lock: after APPEND_LOCK_TIMEOUT another append may hold it
+        server.samples_collection.update_one({"_id": file_id, "append_started_at": now},
+                                             {"$unset": {"append_started_at": ""}})
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = server.jobs_collection.find_one({'_id': job_id})
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({
+        'job_id': job['_id'],
+        'status': job['status'],
+        'file_name': job.get('file_name'),
+        'file_id': job.get('file_id'),
+        'error': job.get('error'),
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+    })
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = server.jobs_collection.find_one({'_id': job_id})
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] == 'failed':
+        return jsonify({'error': job.get('error')}), 500
+    if job['status'] != 'done':
+        return jsonify({'job_id': job['_id'], 'status': job['status']}), 202
+
+    doc = server.samples_collection.find_one({'_id': job['file_id']})
+    if not doc:
+        return jsonify({'error': 'GeoJSON not found'}), 404
+    standards, bad_standards = requested_standards(job.get('standards', ()))
+    if bad_standards:
+        return bad_standards
+    features = load_features(doc)
+    entitlement_payload = build_entitlement_state(job['row_count'], job.get('token_balance', 0))
+    fields = {
+        "file_id": doc["_id"],
+        "entitlement_state": entitlement_payload["entitlement_state"],
+        "billing_state": entitlement_payload["billing_state"],
+        "ui_state": entitlement_payload["ui_state"],
+    }
+    if standards:
+        fields.update(standards_fields(standards, stored_hmpi_profiles(doc, features, standards)))
+    return feature_response(features, fields)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics of this worker: request and stage histograms, counters, cache hits"""
+    caches = {
+        "metal_columns": metal_column_cache_stats(),
+        "results": result_cache_counters,
+        "clusters": cluster_cache_counters,
+        "excel_metadata": excel_metadata_counters,
+        "users": user_cache_counters,
+    }
+    extra = {}
+    for cache, stats in caches.items():
+        extra[("aquascan_cache_hits_total", (("cache", cache),))] = stats["hits"]
+        extra[("aquascan_cache_misses_total", (("cache", cache),))] = stats["misses"]
+    return Response(render_metrics(extra), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Liveness: this worker answers; does not touch MongoDB"""
+    return jsonify({"status": "ok", **worker_status()})
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness: MongoDB answers a ping; reports this worker's connection pool"""
+    pool = {
+        "max_size": MONGO_MAX_POOL_SIZE,
+        "min_size": MONGO_MIN_POOL_SIZE,
+        "open": mongo_pool.open,
+        "in_use": mongo_pool.in_use,
+        "idle": mongo_pool.open - mongo_pool.in_use,
+        "created": mongo_pool.created,
+        "checkout_failures": mongo_pool.checkout_failures,
+        "clears": mongo_pool.clears,
+    }
+    start = time.perf_counter()
+    try:
+        server.client.admin.command("ping")
+    except Exception as e:
+        return jsonify({"status": "unavailable", "error": str(e), "pool": pool, **worker_status()}), 503
+    ping_ms = round((time.perf_counter() - start) * 1000, 2)
+    return jsonify({"status": "ready", "ping_ms": ping_ms, "pool": pool, **worker_status()})
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "metal_columns": metal_column_cache_stats(),
+        "results": dict(result_cache_counters),
+        "clusters": dict(cluster_cache_counters),
+        "excel_metadata": dict(excel_metadata_counters),
+        "users": user_cache_stats(),
+    })
 
 
 @app.route('/geojson/<file_id>', methods=['GET'])
 def get_geojson(file_id):
-    doc = samples_collection.find_one({'_id': file_id})
+    doc = server.samples_collection.find_one({'_id': file_id})
     if not doc:
         return jsonify({'error': 'GeoJSON not found'}), 404
-    return jsonify(doc['GeoJSON'])
+
+    bad_format = check_feature_format()
+    if bad_format:
+        return bad_format
+
+    # Without ?limit= the whole dataset is returned, as before
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        if request.args.get('format', 'geojson') == 'geojson':
+            return jsonify(load_features(doc))
+        return feature_response(load_features(doc), {})
+
+    after = request.args.get('after', default=0, type=int)
+    if limit <= 0 or after < 0:
+        return jsonify({'error': 'limit must be positive and after non-negative'}), 400
+    limit = min(limit, GEOJSON_MAX_PAGE_SIZE)
+
+    features = load_features(doc, after, limit)
+    total = doc.get('feature_count', len(doc.get('GeoJSON', [])))
+    next_after = after + len(features)
+    return feature_response(features, {
+        'next': next_after if next_after < total else None,
+        'total': total,
+    })
+
+
+@app.route('/stats/<file_id>', methods=['GET'])
+def get_stats(file_id):
+    # Datasets from /process have string ids, those from /upload ObjectIds
+    collection, dataset_id = server.samples_collection, file_id
+    doc = collection.find_one({'_id': dataset_id}, {'stats': 1})
+    if not doc and ObjectId.is_valid(file_id):
+        collection, dataset_id = server.db.uploads, ObjectId(file_id)
+        doc = collection.find_one({'_id': dataset_id}, {'stats': 1})
+    if not doc:
+        return jsonify({'error': 'Dataset not found'}), 404
+
+    stats = doc.get('stats')
+    if stats is None or stats.get('version') != STATS_VERSION:
+        # Stored before ingest-time stats (or with an older layout): build them once
+        stats = stats_from_features(load_features(collection.find_one({'_id': dataset_id})))
+        collection.update_one({'_id': dataset_id}, {'$set': {'stats': stats}})
+    return jsonify({'file_id': file_id, **stats})
+
+
+@app.route('/standards', methods=['GET'])
+def list_standards():
+    return jsonify({standard_id: standard_info(standard_id) for standard_id in STANDARD_PROFILES})
+
+
+@app.route('/hmpi/<file_id>', methods=['GET'])
+def get_hmpi_by_standard(file_id):
+    standards, bad_standards = requested_standards(STANDARD_PROFILES)
+    if bad_standards:
+        return bad_standards
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after', default=0, type=int)
+    if limit is not None and (limit <= 0 or after < 0):
+        return jsonify({'error': 'limit must be positive and after non-negative'}), 400
+
+    doc = server.samples_collection.find_one({'_id': file_id})
+    if not doc:
+        return jsonify({'error': 'Dataset not found'}), 404
+
+    if limit is None:
+        features = load_features(doc)
+    else:
+        limit = min(limit, GEOJSON_MAX_PAGE_SIZE)
+        features = load_features(doc, after, limit)
+    # Stored concentrations are already filled; the μg/L decision is the
+    # dataset's, so a page is converted the same way as the whole
+    params = doc.get('pipeline_params')
+    if params is None:
+        params = pipeline_params_from_features(features if limit is None else load_features(doc))
+
+    columns = features_to_columns(features)
+    hmpi = columns_hmpi_profiles(columns, standards, params['convert_units'])
+
+    payload = {
+        'file_id': file_id,
+        'standards': {s: standard_info(s) for s in standards},
+        'count': columns['count'],
+        'Sample_ID': columns['Sample_ID'],
+        # One HMPI column per standard, null where it has no limit for any metal
+        'HMPI': {s: [None if v != v else v for v in row.tolist()] for s, row in zip(standards, hmpi)},
+    }
+    if limit is not None:
+        total = doc.get('feature_count', len(doc.get('GeoJSON', [])))
+        payload['next'] = after + len(features) if after + len(features) < total else None
+        payload['total'] = total
+    return jsonify(payload)
+
+
+@app.route('/geojson/<file_id>/query', methods=['GET'])
+def query_geojson(file_id):
+    """Features of a dataset inside ?bbox= or ?near=&radius=, optionally with ?min_hmpi="""
+    # Datasets from /process have string ids, those from /upload ObjectIds
+    dataset_ids, upload = [file_id], None
+    if ObjectId.is_valid(file_id):
+        upload = server.db.uploads.find_one({'_id': ObjectId(file_id)}, {'dataset_id': 1, 'feature_count': 1})
+        dataset_ids.append(feature_source_id(upload) if upload else ObjectId(file_id))
+    query = {"dataset_id": {"$in": dataset_ids}}
+    dataset = upload or server.samples_collection.find_one({'_id': file_id}, {'feature_count': 1})
+    if dataset and 'feature_count' in dataset:
+        # Points past feature_count belong to an unfinished or failed append,
+        # or were appended to the referenced dataset after this upload
+        query["idx"] = {"$lt": dataset['feature_count']}
+    try:
+        if request.args.get('bbox'):
+            min_lon, min_lat, max_lon, max_lat = parse_floats(request.args['bbox'], 4)
+            if not (valid_lonlat(min_lon, min_lat) and valid_lonlat(max_lon, max_lat)):
+                return jsonify({'error': 'bbox longitudes must be within ±180 and latitudes within ±90'}), 400
+            query["location"] = {"$geoWithin": {"$geometry": bbox_geometry(min_lon, min_lat, max_lon, max_lat)}}
+        elif request.args.get('near'):
+            lon, lat = parse_floats(request.args['near'], 2)
+            if not valid_lonlat(lon, lat):
+                return jsonify({'error': 'near longitude must be within ±180 and latitude within ±90'}), 400
+            radius = float(request.args.get('radius', 1000))
+            if not (math.isfinite(radius) and radius > 0):
+                return jsonify({'error': 'radius must be a positive number of metres'}), 400
+            query["location"] = {"$nearSphere": {
+                "$geometry": {"type": "Point", "coordinates": [lon, lat]},
+                "$maxDistance": radius,
+            }}
+        else:
+            return jsonify({'error': 'Either bbox=minLon,minLat,maxLon,maxLat or near=lon,lat is required'}), 400
+        if request.args.get('min_hmpi'):
+            min_hmpi = float(request.args['min_hmpi'])
+            if not math.isfinite(min_hmpi):
+                return jsonify({'error': 'min_hmpi must be a finite number'}), 400
+            query["HMPI"] = {"$gte": min_hmpi}
+        limit = min(int(request.args.get('limit', GEOJSON_MAX_PAGE_SIZE)), GEOJSON_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'Invalid query parameters'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    # One point past the limit tells whether the result was cut off
+    try:
+        points = list(server.feature_points.find(query, {"feature": 1}).limit(limit + 1))
+    except OperationFailure as e:
+        # e.g. a geometry the 2dsphere index cannot use
+        return jsonify({'error': f'Invalid query: {e}'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    features = [p["feature"] for p in points[:limit]]
+    return jsonify({
+        'GeoJSON': features,
+        'count': len(features),
+        'truncated': len(points) > limit,
+    })
+
+
+@app.route('/tiles/<file_id>/<int:z>/<int:x>/<int:y>', methods=['GET'])
+def get_tile(file_id, z, x, y):
+    """
+    Map tile of a dataset. Below CLUSTER_MAX_ZOOM the tile holds grid clusters
+    with count, mean/max HMPI and dominant metal; from there on the samples.
+    """
+    if z > TILE_MAX_ZOOM or not (0 <= x < 1 << z and 0 <= y < 1 << z):
+        return jsonify({'error': 'Tile out of range'}), 400
+    doc = server.samples_collection.find_one({'_id': file_id}, {'feature_count': 1, 'chunk_size': 1})
+    if not doc:
+        return jsonify({'error': 'File not found'}), 404
+
+    if z >= CLUSTER_MAX_ZOOM:
+        query = {
+            "dataset_id": file_id,
+            "location": {"$geoWithin": {"$geometry": bbox_geometry(*tile_bounds(z, x, y))}},
+        }
+        if 'feature_count' in doc:
+            query["idx"] = {"$lt": doc['feature_count']}
+        points = server.feature_points.find(query, {"feature": 1}).limit(GEOJSON_MAX_PAGE_SIZE)
+        return jsonify({'type': 'points', 'features': [p["feature"] for p in points]})
+
+    # Legacy inline datasets need their GeoJSON to be clustered
+    if 'feature_count' not in doc:
+        doc = server.samples_collection.find_one({'_id': file_id})
+    index = get_cluster_index(doc)
+    return jsonify({'type': 'clusters', 'features': index.tile(z, x, y)})
 
 
 @app.route('/download/<file_id>', methods=['GET'])
 def download_file(file_id):
-    doc = samples_collection.find_one({'_id': file_id})
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unsupported format, use one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    if fmt == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return jsonify({'error': 'Parquet export requires pyarrow'}), 501
+
+    doc = server.samples_collection.find_one({'_id': file_id})
     if not doc:
         return jsonify({'error': 'File not found'}), 404
 
-    df = pd.DataFrame(doc['GeoJSON'])
-    csv_buffer = io.StringIO()
-    df.to_csv(csv_buffer, index=False)
-    return send_file(
-        io.BytesIO(csv_buffer.getvalue().encode()),
-        download_name='processed.csv',
-        as_attachment=True
+    # Rows are streamed straight from the chunk cursor, one chunk at a time
+    batches = iter_feature_batches(doc)
+    if fmt == 'csv':
+        body = export_csv(batches)
+    elif fmt == 'csv.gz':
+        body = export_gzip(export_csv(batches))
+    elif fmt == 'parquet':
+        body = export_parquet(batches)
+    else:
+        body = export_ndjson(batches)
+
+    mimetype, download_name = EXPORT_FORMATS[fmt]
+    return Response(
+        body,
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={download_name}'}
     )
 
 if __name__ == '__main__':
@@ -0,0 +1,238 @@
+"""
+ASGI entry point: the Flask app from app.py, with its I/O-bound read routes
+served on an event loop.
+
+/user/<user_id>, /history/<user_id>, /register and /geojson/<file_id> wait on
+MongoDB through PyMongo's AsyncMongoClient instead of holding a thread. Their
+responses are still built by the Flask app (same JSON provider, compression,
+metrics and Server-Timing), in a worker thread. Every other route, including
+the CPU-heavy /upload and /process, runs the unchanged Flask app on a thread
+pool through a2wsgi, so it never blocks the loop.
+
+Run with:
+    gunicorn -k uvicorn_worker.UvicornWorker asgi:app     # or SERVER_MODE=asgi gunicorn
+    uvicorn asgi:app --workers 2
+"""
+import os
+import time
+from contextlib import asynccontextmanager
+from importlib.util import find_spec
+
+from a2wsgi import WSGIMiddleware
+from bson import ObjectId
+from flask import g, jsonify
+from pymongo import AsyncMongoClient
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+
+import app as backend
+import hmpi_server as server
+
+# Threads running the Flask app for the routes not served natively
+ASGI_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", 8))
+
+flask_app = backend.app
+wsgi = WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)
+HAS_PYARROW = find_spec("pyarrow") is not None
+
+# Created per worker process by the lifespan handler, i.e. after fork
+mongo = None
+
+
+@asynccontextmanager
+async def lifespan(_):
+    global mongo
+    mongo = client = AsyncMongoClient(
+        server.MONGODB_URI,
+        maxPoolSize=server.MONGO_MAX_POOL_SIZE,
+        minPoolSize=server.MONGO_MIN_POOL_SIZE,
+        connectTimeoutMS=server.MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=server.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=server.MONGO_SOCKET_TIMEOUT_MS,
+        waitQueueTimeoutMS=server.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    )
+    try:
+        yield
+    finally:
+        await client.close()
+
+
+def db():
+    return mongo["heavy_metal_db"]
+
+
+def query_int(request, name, default=None):
+    """request.args.get(name, default, type=int), Werkzeug's semantics included"""
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+class Delegated:
+    """Answer with the Flask app itself, for requests the async routes leave to it (mostly errors)"""
+
+    def __init__(self, body):
+        self.body = body
+
+    async def __call__(self, scope, receive, send):
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if replayed:
+                return await receive()
+            replayed = True
+            return {"type": "http.request", "body": self.body, "more_body": False}
+
+        await wsgi(scope, replay, send)
+
+
+async def delegate(request):
+    return Delegated(await request.body())
+
+
+async def render(request, started, build):
+    """
+    Turn build()'s return value into the response the Flask route would send:
+    it runs in a thread, inside a Flask request context for this request, and
+    goes through the app's after_request hooks.
+    """
+    body = await request.body()
+
+    def run():
+        with flask_app.test_request_context(request.url.path, method=request.method,
+                                            query_string=request.url.query,
+                                            headers=list(request.headers.items()), data=body):
+            try:
+                # before_request hooks: index bootstrap, request timer
+                rv = flask_app.preprocess_request()
+                g.request_started = started
+                if rv is None:
+                    rv = build()
+            except Exception as e:
+                try:
+                    rv = flask_app.handle_user_exception(e)
+                except Exception as unhandled:
+                    rv = flask_app.handle_exception(unhandled)
+            return flask_app.process_response(flask_app.make_response(rv))
+
+    response = await run_in_threadpool(run)
+    out = Response(response.get_data(), status_code=response.status_code)
+    out.raw_headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in response.headers.items()]
+    return out
+
+
+async def get_user(request):
+    started = time.perf_counter()
+    user_id = request.path_params["user_id"]
+    if not ObjectId.is_valid(user_id):
+        return await delegate(request)
+    user = await db().users.find_one({"_id": ObjectId(user_id)})
+    if not user:
+        return await render(request, started, lambda: (jsonify({"error": "User not found"}), 404))
+    user["_id"] = str(user["_id"])
+    return await render(request, started, lambda: jsonify(user))
+
+
+async def register_user(request):
+    started = time.perf_counter()
+    try:
+        fields = await request.json()
+        user_doc = {"name": fields["name"], "email": fields["email"]}
+    except Exception:
+        # Flask answers malformed bodies with its usual errors
+        return await delegate(request)
+    result = await db().users.insert_one(user_doc)
+    return await render(request, started, lambda: (
+        jsonify({"msg": "User registered", "user_id": str(result.inserted_id)}), 201))
+
+
+async def user_history(request):
+    started = time.perf_counter()
+    user_id = request.path_params["user_id"]
+    limit = query_int(request, "limit", backend.HISTORY_PAGE_SIZE)
+    before = request.query_params.get("before")
+    if not ObjectId.is_valid(user_id) or limit <= 0 or (before and not ObjectId.is_valid(before)):
+        return await delegate(request)
+
+    user = await db().users.find_one({"_id": ObjectId(user_id)})
+    if not user:
+        return await render(request, started, lambda: (jsonify({"error": "User not found"}), 404))
+    cursor_doc = None
+    if before:
+        cursor_doc = await db().uploads.find_one(
+            {"_id": ObjectId(before), "user_id": ObjectId(user_id)}, {"created_at": 1})
+        if not cursor_doc:
+            return await render(request, started, lambda: (jsonify({"error": "Invalid before cursor"}), 400))
+
+    limit = min(limit, backend.HISTORY_MAX_PAGE_SIZE)
+    uploads = await (db().uploads.find(backend.history_query(ObjectId(user_id), cursor_doc), backend.HISTORY_FIELDS)
+                     .sort(backend.HISTORY_SORT)
+                     .limit(limit + 1)
+                     .to_list())
+    return await render(request, started, lambda: jsonify(backend.history_payload(user, uploads, limit)))
+
+
+async def load_features(doc, after=0, limit=None):
+    """Async form of app.load_features"""
+    if "GeoJSON" in doc:
+        return doc["GeoJSON"][after:None if limit is None else after + limit]
+    query, keep = server.feature_chunk_query(doc, after, limit)
+    features = []
+    async for chunk in db().feature_chunks.find(query, {"features": 1}).sort("seq", 1):
+        features.extend(chunk["features"])
+    return features[keep]
+
+
+async def get_geojson(request):
+    started = time.perf_counter()
+    fmt = request.query_params.get("format", "geojson")
+    limit = query_int(request, "limit")
+    after = query_int(request, "after", 0)
+    if (fmt not in server.FEATURE_FORMATS or (fmt == "arrow" and not HAS_PYARROW)
+            or (limit is not None and (limit <= 0 or after < 0))):
+        return await delegate(request)
+
+    doc = await db().samples.find_one({"_id": request.path_params["file_id"]})
+    if not doc:
+        return await render(request, started, lambda: (jsonify({"error": "GeoJSON not found"}), 404))
+
+    # Without ?limit= the whole dataset is returned, as before
+    if limit is None:
+        features = await load_features(doc)
+        if fmt == "geojson":
+            return await render(request, started, lambda: jsonify(features))
+        return await render(request, started, lambda: server.feature_response(features, {}))
+
+    limit = min(limit, backend.GEOJSON_MAX_PAGE_SIZE)
+    features = await load_features(doc, after, limit)
+    total = doc.get("feature_count", len(doc.get("GeoJSON", [])))
+    next_after = after + len(features)
+    return await render(request, started, lambda: server.feature_response(features, {
+        "next": next_after if next_after < total else None,
+        "total": total,
+    }))
+
+
+def route(path, endpoint, method):
+    """Serve `method` on the event loop; CORS preflights stay with Flask-CORS"""
+    async def dispatch(request):
+        if request.method == "OPTIONS":
+            return await delegate(request)
+        return await endpoint(request)
+    return Route(path, dispatch, methods=[method, "OPTIONS"])
+
+
+app = Starlette(
+    routes=[
+        route("/user/{user_id}", get_user, "GET"),
+        route("/register", register_user, "POST"),
+        route("/history/{user_id}", user_history, "GET"),
+        route("/geojson/{file_id}", get_geojson, "GET"),
+        Mount("/", app=wsgi),
+    ],
+    lifespan=lifespan,
+)
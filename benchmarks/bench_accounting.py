@@ -0,0 +1,115 @@
+"""
+Check that upload accounting stays exact under parallel load and measure
+the latency of the atomic $inc path against the old read-then-$set path.
+
+Needs a running MongoDB (MONGODB_URI), or --mongomock for an in-process
+stand-in without network round trips. Everything is written to a scratch
+database that is dropped afterwards.
+
+Usage:
+    python benchmarks/bench_accounting.py [--threads 16] [--requests 50] [--mongomock]
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "AquaScan_prototype")))
+
+import proj
+
+SAMPLE_CSV = b"Sample_ID,Latitude,Longitude,Pb,Cd\n1,10.5,76.2,0.02,0.001\n2,10.6,76.3,0.01,\n"
+
+
+def legacy_accounting(user_id):
+    """The old path: read the count, insert the upload, write count + 1"""
+    user = proj.server.db.users.find_one({"_id": user_id})
+    proj.server.db.uploads.insert_one({"user_id": user_id, "created_at": datetime.utcnow(), "row_count": 2})
+    proj.server.db.users.update_one({"_id": user_id}, {"$set": {"upload_count": user.get("upload_count", 0) + 1}})
+
+
+def atomic_accounting(user_id):
+    """The current path: the user comes from the worker cache, then one insert and one $inc"""
+    proj.cached_user_entry(user_id)
+    proj.server.db.uploads.insert_one({"user_id": user_id, "created_at": datetime.utcnow(), "row_count": 2})
+    proj.record_uploads(user_id)
+
+
+def run_parallel(fn, user_id, threads, requests):
+    """Run fn(user_id) threads * requests times; returns per-call latencies in ms"""
+    def worker(_):
+        latencies = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            fn(user_id)
+            latencies.append((time.perf_counter() - start) * 1000)
+        return latencies
+
+    with ThreadPoolExecutor(threads) as pool:
+        return [ms for batch in pool.map(worker, range(threads)) for ms in batch]
+
+
+def upload_via_api(user_id, total, threads):
+    """POST /upload `total` times from `threads` threads, like concurrent clients"""
+    def post(_):
+        client = proj.app.test_client()
+        response = client.post("/upload", data={
+            "file": (io.BytesIO(SAMPLE_CSV), "sample.csv"),
+            "user_id": str(user_id),
+        }, content_type="multipart/form-data")
+        assert response.status_code == 201, response.get_json()
+
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(post, range(total)))
+
+
+def new_user():
+    return proj.server.db.users.insert_one({"name": "bench", "email": "bench@example.com",
+                                     "upload_count": 0, "token_balance": 0}).inserted_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=50, help="requests per thread")
+    parser.add_argument("--mongomock", action="store_true", help="use mongomock instead of MONGODB_URI")
+    args = parser.parse_args()
+    expected = args.threads * args.requests
+    if args.mongomock:
+        import mongomock
+        proj.server.client = mongomock.MongoClient()
+
+    db_name = f"aquascan_bench_{uuid.uuid4().hex[:8]}"
+    proj.server.db = proj.server.client[db_name]
+    for name in ("samples_collection", "result_cache", "feature_chunks", "feature_points", "jobs_collection"):
+        setattr(proj.server, name, proj.server.db[getattr(proj.server, name).name])
+    try:
+        print(f"{'path':>8} {'uploads':>8} {'counted':>8} {'lost':>6} {'p50 ms':>7} {'p95 ms':>7}")
+        for label, fn in (("legacy", legacy_accounting), ("atomic", atomic_accounting)):
+            user_id = new_user()
+            latencies = run_parallel(fn, user_id, args.threads, args.requests)
+            counted = proj.server.db.users.find_one({"_id": user_id})["upload_count"]
+            p95 = statistics.quantiles(latencies, n=20)[-1]
+            print(f"{label:>8} {expected:>8} {counted:>8} {expected - counted:>6} "
+                  f"{statistics.median(latencies):>7.2f} {p95:>7.2f}")
+            if label == "atomic":
+                assert counted == expected, f"atomic path lost {expected - counted} increments"
+
+        # End to end through /upload, with the result cache and user cache in play
+        user_id = new_user()
+        upload_via_api(user_id, expected, args.threads)
+        counted = proj.server.db.users.find_one({"_id": user_id})["upload_count"]
+        stored = proj.server.db.uploads.count_documents({"user_id": user_id})
+        assert counted == stored == expected, (counted, stored, expected)
+        print(f"/upload: {expected} parallel requests, upload_count {counted}, uploads stored {stored}")
+    finally:
+        proj.server.client.drop_database(db_name)
+
+
+if __name__ == "__main__":
+    main()
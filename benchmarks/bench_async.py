@@ -0,0 +1,157 @@
+"""
+Load-test the I/O-bound read routes under gunicorn's sync workers
+(SERVER_MODE=wsgi) and under uvicorn workers serving asgi:app
+(SERVER_MODE=asgi), at rising client concurrency.
+
+Needs a running MongoDB (MONGODB_URI). A bench user with upload history and
+one dataset are added to heavy_metal_db and removed afterwards.
+
+Usage:
+    python benchmarks/bench_async.py [--workers 2] [--concurrency 4 16 64] [--duration 10]
+"""
+import argparse
+import http.client
+import io
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from pymongo import MongoClient
+from werkzeug.datastructures import FileStorage
+
+from bench_startup import free_port
+from hmpi_pipeline import build_geojson_features, feature_chunk_docs, hmpi_summary, load_file, run_lean_pipeline
+from synthetic import make_groundwater_dataset
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+CHUNK_SIZE = int(os.environ.get("FEATURE_CHUNK_SIZE", 5000))
+
+
+def seed(db, uploads, rows):
+    """Insert a user with `uploads` history entries and a dataset of `rows` samples"""
+    user_id = db.users.insert_one({"name": "bench-async", "email": "bench@example.com"}).inserted_id
+    start = datetime.utcnow()
+    db.uploads.insert_many([
+        {"user_id": user_id, "created_at": start - timedelta(minutes=i), "file_name": f"bench-{i}.csv",
+         "row_count": rows, "feature_count": rows}
+        for i in range(uploads)
+    ])
+    csv = make_groundwater_dataset(rows).to_csv(index=False).encode()
+    df = load_file(FileStorage(io.BytesIO(csv), filename="bench.csv"))
+    features = build_geojson_features(*run_lean_pipeline(df))
+    dataset_id = f"bench-async-{uuid.uuid4()}"
+    db.feature_chunks.insert_many(feature_chunk_docs(dataset_id, features, CHUNK_SIZE))
+    db.samples.insert_one({"_id": dataset_id, "created_at": start, "feature_count": len(features),
+                           "chunk_size": CHUNK_SIZE, "hmpi_stats": hmpi_summary(features)})
+    return user_id, dataset_id
+
+
+def cleanup(db, user_id, dataset_id):
+    db.users.delete_one({"_id": user_id})
+    db.uploads.delete_many({"user_id": user_id})
+    db.feature_chunks.delete_many({"dataset_id": dataset_id})
+    db.samples.delete_one({"_id": dataset_id})
+
+
+def start_server(mode, workers, port):
+    env = dict(os.environ, SERVER_MODE=mode, WEB_CONCURRENCY=str(workers), PORT=str(port))
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{port}"], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+def run_load(port, paths, concurrency, duration):
+    """Each client keeps one connection and cycles through `paths`; returns latencies (s) and errors"""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(offset):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        mine, failed, i = [], 0, offset
+        while time.perf_counter() < stop_at:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path, headers={"Accept-Encoding": "gzip"})
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                continue
+            mine.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per measurement")
+    parser.add_argument("--uploads", type=int, default=200, help="history entries of the bench user")
+    parser.add_argument("--rows", type=int, default=20_000, help="samples in the bench dataset")
+    args = parser.parse_args()
+
+    db = MongoClient(os.environ.get("MONGODB_URI", "mongodb://localhost:27017/"))["heavy_metal_db"]
+    user_id, dataset_id = seed(db, args.uploads, args.rows)
+    paths = [
+        f"/user/{user_id}",
+        f"/history/{user_id}?limit=50",
+        f"/geojson/{dataset_id}?limit=500&after=1000",
+    ]
+    try:
+        print(f"{'mode':>5} {'clients':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for mode in ("wsgi", "asgi"):
+            port = free_port()
+            proc = start_server(mode, args.workers, port)
+            try:
+                run_load(port, paths, 4, 2.0)  # warm up pools and caches
+                for concurrency in args.concurrency:
+                    latencies, errors = run_load(port, paths, concurrency, args.duration)
+                    if not latencies:
+                        print(f"{mode:>5} {concurrency:>8} {'-':>8} {'-':>8} {'-':>8} {errors:>7}")
+                        continue
+                    p99 = statistics.quantiles(latencies, n=100)[-1] if len(latencies) > 1 else latencies[0]
+                    print(f"{mode:>5} {concurrency:>8} {len(latencies) / args.duration:>8.0f} "
+                          f"{statistics.median(latencies) * 1000:>8.2f} {p99 * 1000:>8.2f} {errors:>7}")
+            finally:
+                proc.terminate()
+                proc.wait()
+    finally:
+        cleanup(db, user_id, dataset_id)
+
+
+if __name__ == "__main__":
+    main()
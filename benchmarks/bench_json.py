@@ -0,0 +1,72 @@
+"""
+Compare encoding time and payload size of Flask's default JSON provider
+against FastJSONProvider, plus the cost of gzip/brotli on the result.
+
+Usage:
+    python benchmarks/bench_json.py [--sizes 10000 100000] [--repeat 3]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from flask.json.provider import DefaultJSONProvider
+
+from app import app
+from hmpi_pipeline import build_geojson_features, run_lean_pipeline
+from hmpi_server import COMPRESS_LEVEL, FastJSONProvider, brotli, orjson
+from bench_feature_builder import make_dataframe
+
+
+def best_time(fn, repeat):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    if orjson is None:
+        sys.exit("orjson is not installed")
+
+    default_provider = DefaultJSONProvider(app)
+    fast_provider = FastJSONProvider(app)
+
+    print(f"{'features':>9} {'flask (s)':>10} {'fast (s)':>9} {'speedup':>8} {'MB':>6} "
+          f"{'gzip (s)':>9} {'gzip MB':>8} {'br (s)':>7} {'br MB':>6}")
+    with app.app_context():
+        for n in args.sizes:
+            df_hmpi, merged_cols = run_lean_pipeline(make_dataframe(n))
+            features = build_geojson_features(df_hmpi, merged_cols)
+            payload = {"file_id": "bench", "GeoJSON": features}
+
+            flask_s, flask_body = best_time(lambda: default_provider.dumps(payload).encode(), args.repeat)
+            fast_s, fast_body = best_time(lambda: fast_provider.encode(payload), args.repeat)
+            # The default provider writes NaN literals, which JSON.parse rejects
+            assert b"NaN" not in fast_body
+            reference = json.loads(flask_body.replace(b"NaN", b"null"))
+            assert json.loads(fast_body) == reference, "payloads differ"
+
+            gzip_s, gzip_body = best_time(lambda: gzip.compress(fast_body, compresslevel=COMPRESS_LEVEL), args.repeat)
+            if brotli is not None:
+                br_s, br_body = best_time(lambda: brotli.compress(fast_body, quality=min(COMPRESS_LEVEL, 11)),
+                                          args.repeat)
+                br_cols = f"{br_s:>7.4f} {len(br_body) / 1e6:>6.2f}"
+            else:
+                br_cols = f"{'-':>7} {'-':>6}"
+            print(f"{n:>9,} {flask_s:>10.4f} {fast_s:>9.4f} {flask_s / fast_s:>7.1f}x {len(fast_body) / 1e6:>6.2f} "
+                  f"{gzip_s:>9.4f} {len(gzip_body) / 1e6:>8.2f} {br_cols}")
+
+
+if __name__ == "__main__":
+    main()
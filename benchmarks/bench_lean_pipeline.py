@@ -0,0 +1,73 @@
+"""
+Compare peak memory and latency of the lean matrix pipeline against
+preprocess_dataframe + compute_hmpi_vectorized.
+
+Usage:
+    python benchmarks/bench_lean_pipeline.py [--sizes 10000 100000 1000000] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from hmpi_pipeline import compute_hmpi_vectorized, preprocess_dataframe, run_lean_pipeline
+from bench_feature_builder import make_dataframe
+
+
+def legacy_pipeline(df):
+    df_clean, merged_cols = preprocess_dataframe(df)
+    return compute_hmpi_vectorized(df_clean, merged_cols), merged_cols
+
+
+def best_time(fn, df, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(df)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(fn, df):
+    tracemalloc.start()
+    try:
+        fn(df)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'input MB':>9} {'legacy MB':>10} {'lean MB':>8} "
+          f"{'legacy (s)':>11} {'lean (s)':>9} {'speedup':>8}")
+    for n in args.sizes:
+        df = make_dataframe(n)
+        input_mb = df.memory_usage(deep=True).sum() / 1e6
+
+        legacy, merged_cols = legacy_pipeline(df)
+        lean, _ = run_lean_pipeline(df)
+        assert np.allclose(legacy["HMPI"], lean["HMPI"], equal_nan=True), "HMPI differs"
+        for metal in merged_cols:
+            assert np.allclose(legacy[metal], lean[metal], equal_nan=True), f"{metal} differs"
+
+        legacy_mb = peak_memory(legacy_pipeline, df) / 1e6
+        lean_mb = peak_memory(run_lean_pipeline, df) / 1e6
+        legacy_s = best_time(legacy_pipeline, df, args.repeat)
+        lean_s = best_time(run_lean_pipeline, df, args.repeat)
+
+        print(f"{n:>10} {input_mb:>9.1f} {legacy_mb:>10.1f} {lean_mb:>8.1f} "
+              f"{legacy_s:>11.4f} {lean_s:>9.4f} {legacy_s / lean_s:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
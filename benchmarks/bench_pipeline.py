@@ -0,0 +1,150 @@
+"""
+Time each stage of the HMPI pipeline in hmpi_pipeline.py on synthetic groundwater data
+and write the results as JSON, so runs can be compared between releases.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--rows 10000 100000] [--repeat 3] [-o results.json]
+    python benchmarks/bench_pipeline.py --baseline previous.json   # print ratios against an older run
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import warnings
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from werkzeug.datastructures import FileStorage
+
+import hmpi_pipeline as pipeline
+from synthetic import METAL_PROFILES, UNITS, make_groundwater_dataset
+
+STRATEGIES = ("half", "zero", "mean", "median", "none")
+
+
+def measure(fn, repeat, setup=None):
+    """Best and mean wall time of fn(setup()) over `repeat` runs; setup is not timed"""
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - start)
+    return {"best_s": min(times), "mean_s": sum(times) / len(times)}
+
+
+def upload(data, filename):
+    return lambda: FileStorage(io.BytesIO(data), filename=filename)
+
+
+def stage_timings(df, args):
+    """Yield (stage, timing) for every pipeline stage on one dataset"""
+    csv_bytes = df.to_csv(index=False).encode()
+    yield "load_file[csv]", measure(pipeline.load_file, args.repeat, upload(csv_bytes, "bench.csv"))
+    if len(df) <= args.xlsx_max_rows:
+        buffer = io.BytesIO()
+        df.to_excel(buffer, index=False)
+        yield "load_file[xlsx]", measure(pipeline.load_file, args.repeat, upload(buffer.getvalue(), "bench.xlsx"))
+
+    # The detector memoizes header layouts; clear it to time the real work
+    def detect_cold(_):
+        pipeline._detect_metal_columns_cached.cache_clear()
+        return pipeline.detect_metal_columns(df)
+    yield "detect_metal_columns", measure(detect_cold, args.repeat)
+    yield "detect_metal_columns[cached]", measure(lambda _: pipeline.detect_metal_columns(df), args.repeat)
+
+    metal_cols = pipeline.detect_metal_columns(df)
+    yield "merge_metal_columns", measure(lambda _: pipeline.merge_metal_columns(df, metal_cols), args.repeat)
+
+    df_merged, merged_cols = pipeline.merge_metal_columns(df, metal_cols)
+    for strategy in STRATEGIES:
+        yield (f"handle_missing_values[{strategy}]",
+               measure(lambda _: pipeline.handle_missing_values(df_merged, merged_cols, strategy), args.repeat))
+
+    df_clean = pipeline.handle_missing_values(df_merged, merged_cols)
+    yield "compute_hmpi_vectorized", measure(lambda _: pipeline.compute_hmpi_vectorized(df_clean, merged_cols), args.repeat)
+    yield "run_lean_pipeline", measure(lambda _: pipeline.run_lean_pipeline(df), args.repeat)
+
+    df_hmpi, lean_cols = pipeline.run_lean_pipeline(df)
+    yield "build_geojson_features", measure(lambda _: pipeline.build_geojson_features(df_hmpi, lean_cols), args.repeat)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_baseline(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r["stage"], r["rows"]): r["best_s"] for r in json.load(f)["results"]}
+    print(f"\n{'stage':<34} {'rows':>9} {'before (s)':>11} {'now (s)':>9} {'ratio':>7}")
+    for r in results:
+        before = baseline.get((r["stage"], r["rows"]))
+        if before:
+            print(f"{r['stage']:<34} {r['rows']:>9,} {before:>11.4f} {r['best_s']:>9.4f} {r['best_s'] / before:>6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--metals", nargs="+", choices=list(METAL_PROFILES))
+    parser.add_argument("--nan-rate", type=float, default=0.1)
+    parser.add_argument("--units", choices=UNITS, default="mg/L")
+    parser.add_argument("--messy-headers", action="store_true")
+    parser.add_argument("--xlsx-max-rows", type=int, default=100_000,
+                        help="skip the Excel loader above this size, writing big workbooks is slow")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'stage':<34} {'rows':>9} {'best (s)':>9} {'mean (s)':>9}")
+    # handle_missing_values' inplace fills warn under pandas copy-on-write
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for rows in args.rows:
+            df = make_groundwater_dataset(rows, args.metals, args.nan_rate, args.units, args.messy_headers)
+            for stage, timing in stage_timings(df, args):
+                results.append({"stage": stage, "rows": rows, "repeat": args.repeat, **timing})
+                print(f"{stage:<34} {rows:>9,} {timing['best_s']:>9.4f} {timing['mean_s']:>9.4f}")
+
+    report = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "excel_engine": pipeline.excel_engine("bench.xlsx"),
+            "dataset": {
+                "metals": args.metals or list(METAL_PROFILES),
+                "nan_rate": args.nan_rate,
+                "units": args.units,
+                "messy_headers": args.messy_headers,
+            },
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nwrote {args.output}")
+    if args.baseline:
+        print_baseline(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Compare reporting HMPI against K standard profiles in one pass
+(run_lean_pipeline(..., standards=[...]), one K x metals weight-matrix
+product) with re-running the pipeline once per standard.
+
+Profiles beyond the built-in ones are copies of them with scaled limits.
+
+Usage:
+    python benchmarks/bench_standards.py [--rows 100000 1000000] [--profiles 1 2 4 8 16] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import hmpi_pipeline as pipeline
+from synthetic import make_groundwater_dataset
+
+
+def register_profiles(count, seed=0):
+    """Ids of `count` profiles: the built-in ones, then scaled copies of them"""
+    rng = np.random.default_rng(seed)
+    ids = list(pipeline.STANDARD_PROFILES)
+    base = list(ids)
+    while len(ids) < count:
+        source = pipeline.STANDARD_PROFILES[base[len(ids) % len(base)]]
+        profile_id = f"bench_{len(ids)}"
+        pipeline.STANDARD_PROFILES[profile_id] = {
+            "name": profile_id,
+            "version": None,
+            "limits": {metal: limit * rng.uniform(0.5, 2.0) for metal, limit in source["limits"].items()},
+        }
+        ids.append(profile_id)
+    return ids[:count]
+
+
+def best_time(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--profiles", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    ids = register_profiles(max(args.profiles))
+    print(f"{'rows':>10} {'K':>4} {'K runs s':>10} {'one pass s':>11} {'speedup':>8}"
+          f" {'engine K x 1 s':>15} {'engine K s':>11}")
+    # The 'half' fill warns on all-NaN slices of sparse metals
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for rows in args.rows:
+            df = make_groundwater_dataset(rows)
+            metals, conc = pipeline.build_concentration_matrix(df, pipeline.detect_metal_columns(df))
+            pipeline.fill_missing_matrix(conc, metals)
+            for k in args.profiles:
+                standards = ids[:k]
+
+                # Same numbers either way, up to rounding in the matrix product
+                combined, _ = pipeline.run_lean_pipeline(df, standards=standards)
+                for standard in standards:
+                    separate, _ = pipeline.run_lean_pipeline(df, standards=[standard])
+                    column = f"HMPI_{standard}"
+                    if not np.allclose(separate[column], combined[column], rtol=1e-12, equal_nan=True):
+                        raise SystemExit(f"{column} differs between the one-pass and per-standard runs")
+
+                separate_s = best_time(
+                    lambda: [pipeline.run_lean_pipeline(df, standards=[s]) for s in standards], args.repeat)
+                combined_s = best_time(lambda: pipeline.run_lean_pipeline(df, standards=standards), args.repeat)
+                profiles = [pipeline.STANDARD_PROFILES[s] for s in standards]
+                engine_separate_s = best_time(
+                    lambda: [pipeline.compute_hmpi_profiles(conc, metals, [p]) for p in profiles], args.repeat)
+                engine_s = best_time(lambda: pipeline.compute_hmpi_profiles(conc, metals, profiles), args.repeat)
+                print(f"{rows:>10,} {k:>4} {separate_s:>10.4f} {combined_s:>11.4f} {separate_s / combined_s:>7.1f}x"
+                      f" {engine_separate_s:>15.4f} {engine_s:>11.4f}")
+
+
+if __name__ == "__main__":
+    main()
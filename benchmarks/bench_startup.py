@@ -0,0 +1,101 @@
+"""
+Measure how long gunicorn workers take to answer their first request, with
+and without preloading the app in the master (GUNICORN_PRELOAD).
+
+Starts gunicorn on a free local port, polls /health from several threads and
+records when each worker pid first answers. /health does not touch MongoDB,
+so no database is needed.
+
+Usage:
+    python benchmarks/bench_startup.py [--workers 4] [--runs 3]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def import_time():
+    """Seconds a fresh interpreter needs to import the app"""
+    code = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def start_workers(workers, preload, timeout):
+    """Launch gunicorn; returns {pid: seconds from launch to that worker's first answer}"""
+    port = free_port()
+    env = dict(os.environ, GUNICORN_PRELOAD="1" if preload else "0", WEB_CONCURRENCY=str(workers))
+    launched = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{port}", "app:app"],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first_answer = {}
+    lock = threading.Lock()
+    deadline = launched + timeout
+
+    def poll():
+        while time.perf_counter() < deadline:
+            with lock:
+                if len(first_answer) >= workers:
+                    return
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                    pid = json.load(response)["pid"]
+            except OSError:
+                time.sleep(0.005)
+                continue
+            with lock:
+                first_answer.setdefault(pid, time.perf_counter() - launched)
+
+    threads = [threading.Thread(target=poll) for _ in range(workers * 2)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+    return first_answer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for all workers")
+    args = parser.parse_args()
+
+    print(f"import app: {import_time():.3f}s in a fresh interpreter\n")
+    print(f"{'mode':>10} {'run':>4} {'workers up':>11} {'first (s)':>10} {'last (s)':>9}   per worker (s)")
+    for preload in (False, True):
+        mode = "preload" if preload else "no-preload"
+        lasts = []
+        for run in range(1, args.runs + 1):
+            answers = sorted(start_workers(args.workers, preload, args.timeout).values())
+            if not answers:
+                print(f"{mode:>10} {run:>4} {'0':>11}   gunicorn did not answer within {args.timeout:.0f}s")
+                continue
+            lasts.append(answers[-1])
+            print(f"{mode:>10} {run:>4} {len(answers):>11} {answers[0]:>10.3f} {answers[-1]:>9.3f}   "
+                  + " ".join(f"{s:.3f}" for s in answers))
+        if lasts:
+            print(f"{mode:>10} median time until every worker answered: {statistics.median(lasts):.3f}s\n")
+
+
+if __name__ == "__main__":
+    main()
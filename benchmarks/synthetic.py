@@ -0,0 +1,104 @@
+"""
+Synthetic groundwater quality datasets for benchmarks.
+
+Rows look like lab exports: a sample id, coordinates, a few non-metal
+parameters and one column per metal, with configurable row count, metal mix,
+missing-value rate, units and header spelling.
+
+Usage:
+    python benchmarks/synthetic.py --rows 100000 --units ug/L --messy-headers -o samples.csv
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Chemical symbol and a typical groundwater concentration in mg/L per metal
+METAL_PROFILES = {
+    "Mercury": ("Hg", 0.0005),
+    "Lead": ("Pb", 0.01),
+    "Cadmium": ("Cd", 0.002),
+    "Arsenic": ("As", 0.008),
+    "Chromium": ("Cr", 0.03),
+    "Nickel": ("Ni", 0.015),
+    "Copper": ("Cu", 0.5),
+    "Zinc": ("Zn", 1.0),
+    "Iron": ("Fe", 0.3),
+    "Manganese": ("Mn", 0.08),
+}
+
+UNITS = ("mg/L", "ug/L")
+
+# Header spellings seen in lab exports. Symbols only: full names such as
+# "Arsenic" or "Mercury" contain other metals' keywords ("ni", "cu").
+MESSY_HEADERS = (
+    "{sym}",
+    "{sym_lower}_conc",
+    "{sym_upper} ({unit})",
+    " Dissolved {sym} ",
+    "{sym}-{unit_compact}",
+)
+
+
+def metal_header(symbol, unit, messy, rng):
+    if not messy:
+        return f"{symbol}_conc"
+    template = MESSY_HEADERS[rng.integers(len(MESSY_HEADERS))]
+    return template.format(sym=symbol, sym_lower=symbol.lower(), sym_upper=symbol.upper(),
+                           unit=unit, unit_compact=unit.replace("/", ""))
+
+
+def make_groundwater_dataset(rows, metals=None, nan_rate=0.1, units="mg/L", messy_headers=False, seed=0):
+    """
+    Build a DataFrame of `rows` samples.
+
+    metals: names from METAL_PROFILES (default: all of them)
+    nan_rate: share of metal readings and latitudes left empty
+    units: "mg/L", or "ug/L" for values 1000x larger as some labs report them
+    messy_headers: vary metal header spelling, whitespace and unit suffixes
+    """
+    if units not in UNITS:
+        raise ValueError(f"units must be one of {UNITS}")
+    metals = list(METAL_PROFILES) if metals is None else metals
+    rng = np.random.default_rng(seed)
+    scale = 1000.0 if units == "ug/L" else 1.0
+
+    df = pd.DataFrame({
+        "Sample_ID": [f"GW-{i:07d}" for i in range(rows)],
+        "Location": [f"Well {i % 5000}" for i in range(rows)],
+        "Latitude": rng.uniform(8.0, 35.0, rows),
+        "Longitude": rng.uniform(68.0, 97.0, rows),
+        "pH": rng.normal(7.2, 0.4, rows).round(2),
+        "Depth_m": rng.gamma(3.0, 15.0, rows).round(1),
+    })
+    for metal in metals:
+        symbol, typical = METAL_PROFILES[metal]
+        # Log-normal around the typical value, with a heavy tail of hotspots
+        values = rng.lognormal(np.log(typical), 0.8, rows) * scale
+        values[rng.random(rows) < nan_rate] = np.nan
+        df[metal_header(symbol, units, messy_headers, rng)] = values
+    df.loc[rng.random(rows) < nan_rate, "Latitude"] = np.nan
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--metals", nargs="+", choices=list(METAL_PROFILES))
+    parser.add_argument("--nan-rate", type=float, default=0.1)
+    parser.add_argument("--units", choices=UNITS, default="mg/L")
+    parser.add_argument("--messy-headers", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", required=True, help=".csv or .xlsx file to write")
+    args = parser.parse_args()
+
+    df = make_groundwater_dataset(args.rows, args.metals, args.nan_rate, args.units, args.messy_headers, args.seed)
+    if args.output.lower().endswith(".xlsx"):
+        df.to_excel(args.output, index=False)
+    else:
+        df.to_csv(args.output, index=False)
+    print(f"wrote {len(df):,} rows x {len(df.columns)} columns to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
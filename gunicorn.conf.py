@@ -0,0 +1,24 @@
+"""
+Gunicorn settings, read automatically when gunicorn starts in this directory.
+
+The app is imported once in the master and the workers are forked from it
+(preload_app), so the pandas/Flask import cost is paid once instead of once
+per worker. That is safe because the MongoDB client only connects on first
+use and every forked worker builds its own (see connect_mongo in
+hmpi_server.py).
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+# SERVER_MODE=asgi serves asgi:app on uvicorn workers, where the I/O-bound
+# read routes wait on MongoDB on an event loop instead of holding a worker.
+# An app given on the command line (gunicorn app:app) takes precedence.
+if os.environ.get("SERVER_MODE", "wsgi") == "asgi":
+    wsgi_app = "asgi:app"
+    worker_class = "uvicorn_worker.UvicornWorker"
+else:
+    wsgi_app = "app:app"
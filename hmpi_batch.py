@@ -0,0 +1,239 @@
+"""
+Run the HMPI pipeline over many CSV/Excel files in parallel, outside the web app.
+
+Each input file becomes one Parquet or GeoJSON file in the output directory,
+or one dataset in MongoDB stored the way the web app stores uploads (a samples
+document plus feature_chunks and feature_points). Finished files are recorded
+in a state file, so rerunning the same command after a crash or Ctrl-C only
+processes what is left.
+
+Usage:
+    python hmpi_batch.py data/ -o out/                       # Parquet, one file per input
+    python hmpi_batch.py "data/**/*.xlsx" -o out/ --format geojson --workers 8
+    python hmpi_batch.py data/ --mongo                       # bulk-insert into MONGODB_URI
+"""
+import argparse
+import glob
+import hashlib
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from werkzeug.datastructures import FileStorage
+
+from hmpi_pipeline import (
+    PIPELINE_FINGERPRINT, allowed_file, build_geojson_features, dataset_fields, export_parquet,
+    feature_chunk_docs, feature_point_docs, hmpi_summary, load_file, run_lean_pipeline,
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FEATURE_CHUNK_SIZE = int(os.environ.get("FEATURE_CHUNK_SIZE", 5000))
+STATE_FILE_NAME = ".hmpi_batch_state.jsonl"
+
+# One MongoDB client per worker process, opened on its first insert
+_db = None
+
+
+def mongo_db():
+    global _db
+    if _db is None:
+        from pymongo import MongoClient
+        _db = MongoClient(os.environ.get("MONGODB_URI", "mongodb://localhost:27017/"))["heavy_metal_db"]
+    return _db
+
+
+def find_inputs(patterns):
+    """Expand directories (recursively) and glob patterns into a sorted list of supported files"""
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "*")
+        paths.update(p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p) and allowed_file(p))
+    return sorted(paths)
+
+
+def file_key(path, sheet, strategy):
+    """Identity of one unit of work: the file as it is on disk plus the options it is processed with"""
+    st = os.stat(path)
+    raw = json.dumps([os.path.abspath(path), st.st_size, st.st_mtime_ns, sheet, strategy, PIPELINE_FINGERPRINT])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def load_state(path):
+    """Keys of the files a previous run finished"""
+    done = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["key"])
+                except (ValueError, KeyError):
+                    # A line cut short by a crash
+                    continue
+    return done
+
+
+def output_names(paths, keys, ext):
+    """Output file name per input: its stem, disambiguated when two inputs share one"""
+    stems = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+    return [f"{stem}-{key[:8]}.{ext}" if stems.count(stem) > 1 else f"{stem}.{ext}"
+            for stem, key in zip(stems, keys)]
+
+
+def write_atomic(path, chunks):
+    """Write to a temporary file and rename it, so an interrupted run never leaves half a file behind"""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp, path)
+
+
+def nan_to_none(obj):
+    """obj with non-finite floats replaced by None, which JSON has no literal for"""
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: nan_to_none(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [nan_to_none(v) for v in obj]
+    return obj
+
+
+def encode_feature(feature):
+    """Feature as valid JSON: NaN and Infinity become null, as in the web app's responses"""
+    if orjson is not None:
+        return orjson.dumps(feature, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(nan_to_none(feature), default=str, allow_nan=False).encode()
+
+
+def geojson_chunks(features):
+    yield b'{"type":"FeatureCollection","features":['
+    for start in range(0, len(features), FEATURE_CHUNK_SIZE):
+        body = b",".join(encode_feature(f) for f in features[start:start + FEATURE_CHUNK_SIZE])
+        yield (b"," if start else b"") + body
+    yield b"]}"
+
+
+def store_in_mongo(dataset_id, path, row_count, features, fields):
+    """Replace any earlier copy of this dataset, then insert it in the web app's chunked layout"""
+    db = mongo_db()
+    for name in ("feature_chunks", "feature_points"):
+        db[name].delete_many({"dataset_id": dataset_id})
+    db.samples.delete_one({"_id": dataset_id})
+
+    chunks = feature_chunk_docs(dataset_id, features, FEATURE_CHUNK_SIZE)
+    points = feature_point_docs(dataset_id, features)
+    if chunks:
+        db.feature_chunks.insert_many(chunks, ordered=False)
+    if points:
+        db.feature_points.insert_many(points, ordered=False)
+    # The samples document goes in last, so readers never see a dataset without its features
+    db.samples.insert_one({
+        "_id": dataset_id,
+        "created_at": datetime.utcnow(),
+        "file_name": os.path.basename(path),
+        "row_count": row_count,
+        "feature_count": len(features),
+        "chunk_size": FEATURE_CHUNK_SIZE,
+        "hmpi_stats": hmpi_summary(features),
+        "source": "batch",
+        **fields,
+    })
+
+
+def process_file(path, key, output, fmt, sheet, strategy):
+    """Worker entry point: run the pipeline on one file and write or insert its features"""
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        df = load_file(FileStorage(f, filename=os.path.basename(path)), sheet)
+    df_hmpi, merged_cols, params = run_lean_pipeline(df, strategy=strategy, return_params=True)
+    features = build_geojson_features(df_hmpi, merged_cols)
+
+    if fmt == "mongo":
+        # Derived from the file key, so a rerun replaces the dataset instead of duplicating it
+        output = key[:32]
+        store_in_mongo(output, path, len(df), features, dataset_fields(df_hmpi, merged_cols, params))
+    elif fmt == "parquet":
+        batches = (features[i:i + FEATURE_CHUNK_SIZE] for i in range(0, len(features), FEATURE_CHUNK_SIZE))
+        write_atomic(output, export_parquet(batches))
+    else:
+        write_atomic(output, geojson_chunks(features))
+    return {"rows": len(df), "features": len(features), "output": output, "seconds": time.perf_counter() - start}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="directories or glob patterns of .csv/.xls/.xlsx files")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("-o", "--output", help="directory for the output files")
+    target.add_argument("--mongo", action="store_true", help="insert into MongoDB (MONGODB_URI) instead")
+    parser.add_argument("--format", choices=("parquet", "geojson"), default="parquet")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--sheet", help="Excel sheet name or index (default: the first sheet)")
+    parser.add_argument("--strategy", choices=("half", "zero", "mean", "median", "none"), default="half",
+                        help="how missing metal readings are filled")
+    parser.add_argument("--state", help=f"resume file (default: {STATE_FILE_NAME} in the output "
+                                        "directory, or the current directory with --mongo)")
+    parser.add_argument("--restart", action="store_true", help="ignore the resume file and process everything")
+    args = parser.parse_args(argv)
+
+    paths = find_inputs(args.inputs)
+    if not paths:
+        parser.error("no .csv/.xls/.xlsx files matched")
+    fmt = "mongo" if args.mongo else args.format
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    state_path = args.state or os.path.join(args.output or ".", STATE_FILE_NAME)
+    done = set() if args.restart else load_state(state_path)
+
+    keys = [file_key(p, args.sheet, args.strategy) for p in paths]
+    if args.mongo:
+        outputs = [None] * len(paths)
+    else:
+        ext = "json" if fmt == "geojson" else fmt
+        outputs = [os.path.join(args.output, name) for name in output_names(paths, keys, ext)]
+    todo = [(p, k, o) for p, k, o in zip(paths, keys, outputs) if k not in done]
+    skipped = len(paths) - len(todo)
+    print(f"{len(paths)} files, {skipped} already done, {len(todo)} to process with {args.workers} workers")
+
+    ok = failed = rows = nbytes = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool, open(state_path, "a") as state:
+        futures = {pool.submit(process_file, p, k, o, fmt, args.sheet, args.strategy): (p, k) for p, k, o in todo}
+        try:
+            for future in as_completed(futures):
+                path, key = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"FAILED {path}: {e}", file=sys.stderr)
+                    continue
+                ok += 1
+                rows += result["rows"]
+                nbytes += os.path.getsize(path)
+                state.write(json.dumps({"key": key, "path": path, **result}) + "\n")
+                state.flush()
+                print(f"ok {path}: {result['rows']:,} rows in {result['seconds']:.2f}s -> {result['output']}")
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            print("interrupted, rerun the same command to resume", file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    print(f"\n{ok} ok, {failed} failed, {skipped} skipped | {rows:,} rows, {nbytes / 1e6:.1f} MB in {elapsed:.1f}s"
+          f" | {rows / elapsed if elapsed else 0:,.0f} rows/s, {nbytes / 1e6 / elapsed if elapsed else 0:.1f} MB/s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
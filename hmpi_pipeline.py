@@ -0,0 +1,1144 @@
+"""
+HMPI pipeline: reading lab spreadsheets, detecting metal columns, computing
+the Heavy Metal Pollution Index and building GeoJSON features, plus the
+export formats and MongoDB document layouts built from those features.
+
+Shared by the web apps (app.py, AquaScan_prototype/proj.py), their process
+pools and the hmpi_batch.py command-line tool. Importing it opens no
+database connection and creates no Flask app.
+"""
+import os
+import io
+import csv
+import re
+import json
+import zlib
+import base64
+import hashlib
+import threading
+import warnings
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import lru_cache, wraps
+
+import numpy as np
+import pandas as pd
+from werkzeug.datastructures import FileStorage
+
+# Instrumentation hooks. The web apps install request-scoped versions with
+# install_instrumentation(); everywhere else timing and counting are no-ops.
+_stage_hook = None
+_count_dataset_hook = None
+
+
+def install_instrumentation(stage=None, count_dataset=None):
+    """Route stage() and count_dataset() to the given callables"""
+    global _stage_hook, _count_dataset_hook
+    _stage_hook, _count_dataset_hook = stage, count_dataset
+
+
+def stage(name):
+    """Context manager timing a block as one named pipeline stage"""
+    return _stage_hook(name) if _stage_hook is not None else nullcontext()
+
+
+def timed_stage(name):
+    """Decorator form of stage()"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_dataset(df):
+    """Report the size of a parsed upload"""
+    if _count_dataset_hook is not None:
+        _count_dataset_hook(df)
+
+
+METAL_KEYWORDS = {
+    'Mercury': ['hg', 'mercury', 'hg_conc', 'mercury_conc', 'merc'],
+    'Lead': ['pb', 'lead', 'pb_conc', 'lead_conc'],
+    'Cadmium': ['cd', 'cadmium', 'cd_conc'],
+    'Arsenic': ['as', 'arsenic', 'as_conc'],
+    'Chromium': ['cr', 'chromium', 'cr_conc'],
+    'Nickel': ['ni', 'nickel', 'ni_conc'],
+    'Copper': ['cu', 'copper', 'cu_conc'],
+    'Zinc': ['zn', 'zinc', 'zn_conc'],
+    'Iron': ['fe', 'iron', 'fe_conc'],
+    'Manganese': ['mn', 'manganese', 'mn_conc']
+    }
+
+
+NON_ALNUM_RE = re.compile(r'[^a-z0-9]')
+
+
+# Normalized keywords per metal, built once from METAL_KEYWORDS
+METAL_KEYWORD_INDEX = {
+    metal: tuple(dict.fromkeys(NON_ALNUM_RE.sub('', kw.lower()) for kw in keywords))
+    for metal, keywords in METAL_KEYWORDS.items()
+}
+
+
+# Number of distinct header layouts remembered by detect_metal_columns
+METAL_COLUMN_CACHE_SIZE = int(os.environ.get("METAL_COLUMN_CACHE_SIZE", 1024))
+
+
+def allowed_file(filename):
+    return filename.lower().endswith(('.csv','.xls','.xlsx'))
+
+
+@lru_cache(maxsize=METAL_COLUMN_CACHE_SIZE)
+def _detect_metal_columns_cached(columns):
+    cleaned = [(col, NON_ALNUM_RE.sub('', col.lower())) for col in columns]
+    metal_cols = {}
+    for metal, keywords in METAL_KEYWORD_INDEX.items():
+        found_cols = tuple(col for col, col_clean in cleaned if any(kw in col_clean for kw in keywords))
+        if found_cols:
+            metal_cols[metal] = found_cols
+    return metal_cols
+
+
+def detect_metal_columns(df):
+    # Labs resend the same header layout over and over, so the mapping is
+    # cached on the tuple of column names
+    return {metal: list(cols) for metal, cols in _detect_metal_columns_cached(tuple(df.columns)).items()}
+
+
+def metal_column_cache_stats():
+    info = _detect_metal_columns_cached.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
+
+
+def merge_metal_columns(df, metal_cols):
+    merged_df = df.copy()
+    merged_cols = {}
+    for metal, cols in metal_cols.items():
+        # Skip metals with no columns detected
+        if not cols:
+            continue
+        
+        if len(cols) > 1:
+            merged_df[metal] = merged_df[cols].sum(axis=1)
+        else:
+            merged_df[metal] = merged_df[cols[0]]
+        merged_cols[metal] = metal  # only metals present in df
+    return merged_df, merged_cols
+
+
+def validate_geo_columns(df):
+    geo_cols = {}
+    for col in ['Location', 'Latitude', 'Longitude']:
+        matches = [c for c in df.columns if col.lower() in c.lower()]
+        geo_cols[col] = matches[0] if matches else None
+    return geo_cols
+
+
+def handle_missing_values(df, metal_cols, strategy='half', detection_limits=None):
+    df_clean = df.copy()
+    for metal in metal_cols:
+        if metal not in df_clean.columns:
+            continue
+        if strategy=='half':
+            fill_val = 0.5*df_clean[metal].min() if detection_limits is None else 0.5*detection_limits.get(metal,0)
+            df_clean[metal] = df_clean[metal].fillna(fill_val)
+
+        elif strategy=='zero':
+            df_clean[metal].fillna(0, inplace=True)
+        elif strategy=='mean':
+            df_clean[metal].fillna(df_clean[metal].mean(), inplace=True)
+        elif strategy=='median':
+            df_clean[metal].fillna(df_clean[metal].median(), inplace=True)
+        elif strategy=='none':
+            df_clean[metal] = df_clean[metal].astype(float)
+    return df_clean
+
+
+STANDARD_LIMITS = {
+    "Mercury": 0.001,
+    "Lead": 0.01,
+    "Cadmium": 0.003,
+    "Arsenic": 0.01,
+    "Chromium": 0.05,
+    "Nickel": 0.02,
+    "Copper": 2.0,
+    "Zinc": 3.0,
+    "Iron": 0.3,
+    "Manganese": 0.1
+}
+
+
+# Named, versioned limit sets (mg/L) that HMPI can also be reported against.
+# "default" is STANDARD_LIMITS, the one behind the HMPI column. Metals a
+# standard sets no limit for are left out of its index.
+STANDARD_PROFILES = {
+    "default": {
+        "name": "AquaScan default limits",
+        "version": "1",
+        "limits": STANDARD_LIMITS,
+    },
+    "who": {
+        "name": "WHO Guidelines for Drinking-water Quality",
+        "version": "4th edition incorporating the 1st and 2nd addenda (2022)",
+        # Iron and zinc have no health-based guideline value
+        "limits": {"Arsenic": 0.01, "Cadmium": 0.003, "Chromium": 0.05, "Copper": 2.0, "Lead": 0.01,
+                   "Manganese": 0.08, "Mercury": 0.006, "Nickel": 0.07},
+    },
+    "bis_10500": {
+        "name": "BIS IS 10500 Drinking Water Specification, acceptable limits",
+        "version": "IS 10500:2012",
+        "limits": {"Arsenic": 0.01, "Cadmium": 0.003, "Chromium": 0.05, "Copper": 0.05, "Iron": 0.3,
+                   "Lead": 0.01, "Manganese": 0.1, "Mercury": 0.001, "Nickel": 0.02, "Zinc": 5.0},
+    },
+}
+# JSON file of extra profiles ({id: {"name", "version", "limits"}}), e.g. in-house thresholds
+STANDARD_PROFILES_FILE = os.environ.get("STANDARD_PROFILES_FILE")
+
+
+def load_standard_profiles(path):
+    """Read and check a STANDARD_PROFILES_FILE"""
+    with open(path) as f:
+        profiles = json.load(f)
+    for profile_id, profile in profiles.items():
+        limits = profile.get("limits") if isinstance(profile, dict) else None
+        if not isinstance(limits, dict) or not limits:
+            raise ValueError(f"Standard profile {profile_id!r} has no limits")
+        for metal, limit in limits.items():
+            if metal not in METAL_KEYWORDS:
+                raise ValueError(f"Standard profile {profile_id!r}: unknown metal {metal!r}")
+            # bool is an int subclass, but true/false is no limit
+            if isinstance(limit, bool) or not isinstance(limit, (int, float)) or not limit > 0:
+                raise ValueError(f"Standard profile {profile_id!r}: limit for {metal} must be a positive number")
+        profile.setdefault("name", profile_id)
+        profile.setdefault("version", None)
+    return profiles
+
+
+if STANDARD_PROFILES_FILE:
+    STANDARD_PROFILES.update(load_standard_profiles(STANDARD_PROFILES_FILE))
+
+
+def compute_hmpi_vectorized(df, metal_cols, convert_units=None):
+    """
+    Compute HMPI for a dataframe with metal concentrations.
+    Uranium is included in HMPI calculation only if present in DataFrame.
+    convert_units optionally maps metal -> bool to fix the μg/L → mg/L
+    decision instead of deriving it from this DataFrame alone.
+    """
+    df_hmpi = df.copy()
+
+    # Only consider metals present in DataFrame and STANDARD_LIMITS
+    valid_metals = {metal: col for metal, col in metal_cols.items() if metal in STANDARD_LIMITS and col in df_hmpi.columns}
+
+    if not valid_metals:
+        df_hmpi["HMPI"] = np.nan
+        return df_hmpi
+
+    Wi_total = sum(1 / STANDARD_LIMITS[metal] for metal in valid_metals)
+
+    for metal, col in valid_metals.items():
+        Si = STANDARD_LIMITS[metal]
+        Ci = df_hmpi[col].copy()
+
+        # Convert μg/L → mg/L if Ci is much higher than standard (heuristic)
+        if convert_units is not None:
+            to_mg = convert_units.get(metal, False)
+        else:
+            to_mg = (Ci > 100 * Si).any()
+        if to_mg:
+            Ci = Ci / 1000
+
+        Qi = (Ci / Si) * 100
+        Wi = (1 / Si) / Wi_total
+
+        df_hmpi[f"{metal}_Qi"] = Qi
+        df_hmpi[f"{metal}_Wi"] = Wi
+        df_hmpi[f"{metal}_SIi"] = Qi * Wi
+
+    # HMPI = sum of weighted indices (metals detected in dataset)
+    si_columns = [f"{metal}_SIi" for metal in valid_metals]
+    df_hmpi["HMPI"] = df_hmpi[si_columns].sum(axis=1)
+
+    return df_hmpi
+
+
+# Bump whenever the pipeline output changes for the same input file
+PIPELINE_VERSION = 1
+
+
+PIPELINE_FINGERPRINT = hashlib.sha256(json.dumps({
+    "version": PIPELINE_VERSION,
+    "standard_limits": STANDARD_LIMITS,
+    "metal_keywords": METAL_KEYWORDS,
+}, sort_keys=True).encode()).hexdigest()
+
+
+# Rows per chunk when streaming large CSV uploads through the pipeline
+CSV_CHUNK_ROWS = int(os.environ.get("CSV_CHUNK_ROWS", 50000))
+
+
+# Excel reader: "auto" uses calamine when python-calamine is installed and
+# falls back to openpyxl (read-only) for .xlsx and pandas' default for .xls
+EXCEL_ENGINE = os.environ.get("EXCEL_ENGINE", "auto")
+
+
+# Workbooks whose sheet names and headers are remembered, by content hash
+EXCEL_METADATA_CACHE_SIZE = int(os.environ.get("EXCEL_METADATA_CACHE_SIZE", 256))
+
+
+_excel_metadata = OrderedDict()
+
+
+_excel_metadata_lock = threading.Lock()
+
+
+excel_metadata_counters = {"hits": 0, "misses": 0}
+
+
+def excel_engine(filename):
+    if EXCEL_ENGINE != "auto":
+        return EXCEL_ENGINE
+    try:
+        import python_calamine  # noqa: F401
+        return "calamine"
+    except ImportError:
+        return "openpyxl" if filename.lower().endswith(".xlsx") else None
+
+
+def excel_sheet_header(workbook, digest, sheet=None):
+    """
+    Resolve `sheet` (name, index or None for the first sheet) and return it with
+    its header row. Sheet names and headers are cached per workbook digest.
+    """
+    with _excel_metadata_lock:
+        meta = _excel_metadata.get(digest)
+        if meta is not None:
+            _excel_metadata.move_to_end(digest)
+            excel_metadata_counters["hits"] += 1
+        else:
+            excel_metadata_counters["misses"] += 1
+    if meta is None:
+        meta = {"sheets": workbook.sheet_names, "headers": {}}
+        with _excel_metadata_lock:
+            _excel_metadata[digest] = meta
+            while len(_excel_metadata) > EXCEL_METADATA_CACHE_SIZE:
+                _excel_metadata.popitem(last=False)
+
+    sheets = meta["sheets"]
+    if sheet is None or sheet == "":
+        name = sheets[0]
+    elif sheet in sheets:
+        name = sheet
+    elif str(sheet).isdigit() and int(sheet) < len(sheets):
+        name = sheets[int(sheet)]
+    else:
+        raise ValueError(f"Sheet {sheet!r} not found, available sheets: {', '.join(map(str, sheets))}")
+
+    if name not in meta["headers"]:
+        meta["headers"][name] = list(workbook.parse(name, nrows=0).columns)
+    return name, meta["headers"][name]
+
+
+def read_excel(file, sheet=None):
+    """
+    Read one sheet of a workbook, parsing only the columns the pipeline uses:
+    the detected metal columns plus the sample id and geo columns.
+    """
+    data = file.read()
+    workbook = pd.ExcelFile(io.BytesIO(data), engine=excel_engine(file.filename))
+    try:
+        name, header = excel_sheet_header(workbook, hashlib.sha256(data).hexdigest(), sheet)
+        empty = pd.DataFrame(columns=header)
+        wanted = {c for cols in detect_metal_columns(empty).values() for c in cols}
+        wanted.update(c for c in validate_geo_columns(empty).values() if c)
+        wanted.update(FEATURE_PASSTHROUGH_COLUMNS)
+        # Positions rather than names, so duplicate headers cannot confuse usecols
+        usecols = [i for i, c in enumerate(header) if c in wanted]
+        return workbook.parse(name, usecols=usecols or None)
+    finally:
+        workbook.close()
+
+
+@timed_stage("parse")
+def load_file(file, sheet=None):
+    """Reads CSV or Excel into pandas DataFrame; `sheet` picks the Excel sheet"""
+    if file.filename.lower().endswith('.csv'):
+        df = pd.read_csv(file)
+    elif file.filename.lower().endswith(('.xls', '.xlsx')):
+        df = read_excel(file, sheet)
+    else:
+        raise ValueError("Unsupported file format")
+    count_dataset(df)
+    return df
+
+
+def preprocess_dataframe(df):
+    metal_cols = detect_metal_columns(df)      
+    df_merged, merged_cols = merge_metal_columns(df, metal_cols)  
+    
+    if 'Uranium' in merged_cols and 'Uranium' not in df_merged.columns:
+        merged_cols.pop('Uranium')
+    
+    df_clean = handle_missing_values(df_merged, merged_cols, strategy="half")  
+    geo_cols = validate_geo_columns(df_clean)  
+    return df_clean, merged_cols
+
+
+# Source columns carried through to the GeoJSON features as-is
+FEATURE_PASSTHROUGH_COLUMNS = ("Sample_ID", "Latitude", "Longitude")
+
+
+def build_concentration_matrix(df, metal_cols):
+    """
+    Merge each metal's detected columns into one row of a metals x rows
+    float matrix, without copying the DataFrame.
+    """
+    metals = list(metal_cols)
+    conc = np.empty((len(metals), len(df)))
+    for i, metal in enumerate(metals):
+        cols = metal_cols[metal]
+        if len(cols) > 1:
+            conc[i] = df[cols].sum(axis=1)
+        else:
+            conc[i] = df[cols[0]]
+    return metals, conc
+
+
+def fill_missing_matrix(conc, metals, strategy='half', detection_limits=None, fill_values=None):
+    """
+    In-place counterpart of handle_missing_values for a concentration matrix.
+    fill_values maps metals to the 'mean'/'median' fill to use instead of
+    one computed from conc.
+    """
+    if strategy == 'none' or conc.size == 0:
+        return conc
+    missing = np.isnan(conc)
+    if not missing.any():
+        return conc
+
+    # All-NaN metals keep their NaNs, as with the pandas reductions
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if fill_values is not None and strategy in ('mean', 'median'):
+            fill_vals = np.array([fill_values.get(metal) for metal in metals], dtype=float)
+        elif strategy == 'half':
+            if detection_limits is None:
+                fill_vals = 0.5 * np.nanmin(conc, axis=1)
+            else:
+                fill_vals = 0.5 * np.array([detection_limits.get(metal, 0) for metal in metals], dtype=float)
+        elif strategy == 'zero':
+            fill_vals = np.zeros(len(metals))
+        elif strategy == 'mean':
+            fill_vals = np.nanmean(conc, axis=1)
+        elif strategy == 'median':
+            fill_vals = np.nanmedian(conc, axis=1)
+        else:
+            return conc
+
+    rows, cols = np.nonzero(missing)
+    conc[rows, cols] = fill_vals[rows]
+    return conc
+
+
+def unit_conversion_flags(conc, metals, convert_units=None):
+    """
+    Which rows of a metals x rows concentration matrix are in μg/L and need
+    dividing by 1000: taken from convert_units if given, otherwise
+    guessed from readings far above the metal's STANDARD_LIMITS value.
+    The decision is about the data, so it is the same whatever standard
+    HMPI is computed against.
+    """
+    if convert_units is not None:
+        return np.array([bool(convert_units.get(metal, False)) for metal in metals], dtype=bool)
+    Si = np.array([STANDARD_LIMITS.get(metal, np.inf) for metal in metals])
+    # Convert μg/L → mg/L if Ci is much higher than standard (heuristic)
+    return (conc > 100 * Si[:, None]).any(axis=1)
+
+
+def compute_hmpi_matrix(conc, metals, convert_units=None, return_components=False):
+    """
+    Compute HMPI from a metals x rows concentration matrix as one weighted
+    reduction. Returns (hmpi, components); the per-metal Qi/Wi/SIi columns
+    are only built when return_components is True.
+    """
+    valid = [i for i, metal in enumerate(metals) if metal in STANDARD_LIMITS]
+    components = {} if return_components else None
+    if not valid:
+        return np.full(conc.shape[1], np.nan), components
+
+    valid_metals = [metals[i] for i in valid]
+    Ci = conc if len(valid) == len(metals) else conc[valid]
+    Si = np.array([STANDARD_LIMITS[metal] for metal in valid_metals])
+    to_mg = unit_conversion_flags(Ci, valid_metals, convert_units)
+
+    Wi = (1 / Si) / np.sum(1 / Si)
+    # Qi = (Ci / Si) * 100, so HMPI = sum(Qi * Wi) is a single weighted sum over Ci
+    Qi_scale = np.where(to_mg, 1 / 1000, 1.0) / Si * 100
+
+    if return_components:
+        for k, metal in enumerate(valid_metals):
+            Qi = Ci[k] * Qi_scale[k]
+            components[f"{metal}_Qi"] = Qi
+            components[f"{metal}_Wi"] = Wi[k]
+            components[f"{metal}_SIi"] = Qi * Wi[k]
+
+    # Accumulate metal by metal in a fixed order rather than through a BLAS
+    # product, so chunked and single-pass runs give bit-identical results.
+    # NaNs count as zero, like the pandas row sum in compute_hmpi_vectorized
+    weights = Qi_scale * Wi
+    hmpi = np.zeros(Ci.shape[1])
+    for k in range(len(valid_metals)):
+        contrib = weights[k] * Ci[k]
+        contrib[np.isnan(contrib)] = 0.0
+        hmpi += contrib
+    return hmpi, components
+
+
+def standard_weight_matrix(metals, profiles, to_mg):
+    """
+    K x metals matrix whose product with a concentration matrix gives HMPI
+    under each of the K profiles: entry (k, m) is 100 * Wi / Si for metal m
+    under profile k, divided by 1000 for μg/L readings, and 0 where the
+    profile sets no limit for the metal.
+    """
+    weights = np.zeros((len(profiles), len(metals)))
+    for k, profile in enumerate(profiles):
+        limits = profile["limits"]
+        cols = [i for i, metal in enumerate(metals) if metal in limits]
+        if not cols:
+            continue
+        Si = np.array([limits[metals[i]] for i in cols], dtype=float)
+        Wi = (1 / Si) / np.sum(1 / Si)
+        weights[k, cols] = Wi / Si * 100
+    return weights * np.where(to_mg, 1 / 1000, 1.0)
+
+
+def compute_hmpi_profiles(conc, metals, profiles, convert_units=None):
+    """
+    HMPI of every row of a metals x rows concentration matrix under each of
+    `profiles` (STANDARD_PROFILES entries), as a single K x metals by
+    metals x rows product. Returns a K x rows array; a profile without a
+    limit for any of the metals gives NaN, as in compute_hmpi_matrix.
+    """
+    to_mg = unit_conversion_flags(conc, metals, convert_units)
+    weights = standard_weight_matrix(metals, profiles, to_mg)
+    # NaNs count as zero, like compute_hmpi_matrix
+    hmpi = weights @ np.where(np.isnan(conc), 0.0, conc)
+    hmpi[~weights.any(axis=1)] = np.nan
+    return hmpi
+
+
+def run_lean_pipeline(df, metal_cols=None, strategy='half', detection_limits=None,
+                      convert_units=None, return_components=False, standards=None, fill_values=None,
+                      return_params=False):
+    """
+    Lean alternative to preprocess_dataframe + compute_hmpi_vectorized.
+    Works on a single concentration matrix instead of copying the whole
+    DataFrame, and returns a narrow frame holding only the passthrough
+    columns, the merged metals and HMPI (plus Qi/Wi/SIi if requested).
+    `standards` lists STANDARD_PROFILES ids to add an HMPI_<id> column for.
+    With return_params, returns (df_hmpi, merged_cols, params), params being
+    dataframe_pipeline_params(df, metal_cols, strategy) taken from the same
+    matrix before it is filled.
+    """
+    if metal_cols is None:
+        with stage("detect"):
+            metal_cols = detect_metal_columns(df)
+    with stage("hmpi"):
+        metals, conc = build_concentration_matrix(df, metal_cols)
+        if return_params:
+            params = matrix_pipeline_params(conc, metals, strategy)
+        fill_missing_matrix(conc, metals, strategy, detection_limits, fill_values)
+        hmpi, components = compute_hmpi_matrix(conc, metals, convert_units, return_components)
+        if standards:
+            by_standard = compute_hmpi_profiles(conc, metals, [STANDARD_PROFILES[s] for s in standards],
+                                                convert_units)
+
+    data = {col: df[col] for col in FEATURE_PASSTHROUGH_COLUMNS if col in df.columns and col not in metals}
+    data.update(zip(metals, conc))
+    data["HMPI"] = hmpi
+    if standards:
+        data.update((f"HMPI_{standard}", row) for standard, row in zip(standards, by_standard))
+    if components:
+        data.update(components)
+    merged_cols = {metal: metal for metal in metals}
+    if return_params:
+        return pd.DataFrame(data, index=df.index), merged_cols, params
+    return pd.DataFrame(data, index=df.index), merged_cols
+
+
+def scan_csv_statistics(file, chunksize=CSV_CHUNK_ROWS):
+    """
+    Cheap first pass over a CSV upload.
+    Reads only the columns the pipeline uses, chunk by chunk, and collects the
+    dataset-wide values that single-pass processing derives from the whole
+    DataFrame: the per-metal minimum (for the 'half' fill) and the
+    μg/L → mg/L unit decision.
+    """
+    header = pd.read_csv(file, nrows=0)
+    file.seek(0)
+    metal_cols = detect_metal_columns(header)
+    metal_source_cols = {c for cols in metal_cols.values() for c in cols}
+    usecols = [c for c in header.columns
+               if c in metal_source_cols or c in ("Sample_ID", "Latitude", "Longitude")]
+
+    metal_min = {metal: np.nan for metal in metal_cols}
+    metal_max = {metal: np.nan for metal in metal_cols}
+    float_cols = set()
+    row_count = 0
+    for chunk in pd.read_csv(file, usecols=usecols, chunksize=chunksize):
+        row_count += len(chunk)
+        float_cols.update(c for c in chunk.columns if chunk[c].dtype.kind == 'f')
+        df_merged, merged_cols = merge_metal_columns(chunk, metal_cols)
+        for metal in merged_cols:
+            metal_min[metal] = np.fmin(metal_min[metal], df_merged[metal].min())
+            metal_max[metal] = np.fmax(metal_max[metal], df_merged[metal].max())
+    file.seek(0)
+
+    # The 'half' fill never exceeds the minimum, so the heuristic in
+    # compute_hmpi_vectorized reduces to a check on the column maximum
+    convert_units = {metal: bool(metal_max[metal] > 100 * STANDARD_LIMITS[metal])
+                     for metal in metal_cols if metal in STANDARD_LIMITS}
+
+    return {
+        "metal_cols": metal_cols,
+        "usecols": usecols,
+        # A column that is float in any chunk is float for the whole file
+        "dtypes": {c: "float64" for c in float_cols},
+        "metal_min": metal_min,
+        "convert_units": convert_units,
+        "row_count": row_count,
+    }
+
+
+def iter_csv_feature_chunks(file, stats, chunksize=CSV_CHUNK_ROWS, summary=None):
+    """
+    Run the HMPI pipeline over a CSV one chunk at a time, yielding GeoJSON
+    features. Each chunk is also added to `summary` (a DatasetStats) if given.
+    """
+    reader = pd.read_csv(file, usecols=stats["usecols"], dtype=stats["dtypes"], chunksize=chunksize)
+    for chunk in reader:
+        # 0.5 * detection limit == 0.5 * dataset-wide minimum for the 'half' fill
+        df_hmpi, merged_cols = run_lean_pipeline(
+            chunk,
+            metal_cols=stats["metal_cols"],
+            detection_limits=stats["metal_min"],
+            convert_units=stats["convert_units"],
+        )
+        if summary is not None:
+            summary.add(df_hmpi, merged_cols)
+        yield build_geojson_features(df_hmpi, merged_cols)
+
+
+def feature_chunk_docs(dataset_id, features, chunk_size, first_seq=0):
+    return [
+        {"dataset_id": dataset_id, "seq": first_seq + i, "features": features[start:start + chunk_size]}
+        for i, start in enumerate(range(0, len(features), chunk_size))
+    ]
+
+
+def valid_coordinates(lon, lat):
+    # 2dsphere rejects anything outside WGS84 bounds (NaN fails the comparisons too)
+    return (isinstance(lon, (int, float)) and isinstance(lat, (int, float))
+            and -180 <= lon <= 180 and -90 <= lat <= 90)
+
+
+def feature_point_docs(dataset_id, features, first_index=0):
+    """One geo-indexed document per feature whose coordinates are present and valid"""
+    docs = []
+    for i, feature in enumerate(features, first_index):
+        if not feature.get("latitudeandlongitudepresent"):
+            continue
+        lon, lat = feature["geometry"]["coordinates"]
+        if not valid_coordinates(lon, lat):
+            continue
+        docs.append({
+            "dataset_id": dataset_id,
+            "idx": i,
+            "location": {"type": "Point", "coordinates": [lon, lat]},
+            "HMPI": feature.get("HMPI"),
+            "feature": feature,
+        })
+    return docs
+
+
+def hmpi_summary(features):
+    """Count, min, max and mean of the features' HMPI values, ignoring missing ones"""
+    values = np.array([f.get("HMPI") for f in features], dtype=float)
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return {"count": 0, "min": None, "max": None, "mean": None}
+    return {
+        "count": int(len(values)),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "mean": float(values.mean()),
+    }
+
+
+# HMPI classes shown by the frontend, as (name, upper bound inclusive)
+POLLUTION_CLASSES = (("safe", 50.0), ("moderate", 100.0), ("risk", np.inf))
+HMPI_PERCENTILES = (5, 25, 50, 75, 90, 95, 99)
+HMPI_HISTOGRAM_BINS = int(os.environ.get("HMPI_HISTOGRAM_BINS", 20))
+# Bump when the layout of DatasetStats.result() changes
+STATS_VERSION = 1
+
+
+def _float_or_none(value):
+    return None if value is None or np.isnan(value) else float(value)
+
+
+class DatasetStats:
+    """
+    Dataset summary accumulated chunk by chunk during ingest: the HMPI
+    distribution (percentiles, histogram, pollution classes) and per-metal
+    count/min/mean/max and exceedances of STANDARD_LIMITS, in mg/L.
+    Pass the streaming path's convert_units so every chunk converts the same
+    way; otherwise each add() applies compute_hmpi_matrix's μg/L heuristic.
+    """
+
+    def __init__(self, convert_units=None):
+        self.convert_units = convert_units
+        self.rows = 0
+        self.hmpi = []
+        self.metals = {}
+
+    @classmethod
+    def resume(cls, stats, hmpi, convert_units=None):
+        """
+        Continue from a stored result() to add new rows to it. `hmpi` holds
+        the dataset's HMPI values so far, which the percentiles and the
+        histogram are rebuilt from; everything else carries over.
+        """
+        acc = cls(convert_units)
+        acc.rows = stats["rows"]
+        acc.hmpi = [np.asarray(hmpi, dtype=float)]
+        for metal, m in stats["metals"].items():
+            acc.metals[metal] = {
+                "count": m["count"],
+                "sum": m["mean"] * m["count"] if m["count"] else 0.0,
+                "min": np.nan if m["min"] is None else m["min"],
+                "max": np.nan if m["max"] is None else m["max"],
+                "exceedances": m["exceedances"],
+            }
+        return acc
+
+    def add(self, df_hmpi, merged_cols):
+        self.rows += len(df_hmpi)
+        if "HMPI" in df_hmpi.columns:
+            self.hmpi.append(df_hmpi["HMPI"].to_numpy(dtype=float))
+        for metal in merged_cols:
+            if metal not in df_hmpi.columns:
+                continue
+            values = df_hmpi[metal].to_numpy(dtype=float)
+            values = values[~np.isnan(values)]
+            limit = STANDARD_LIMITS.get(metal)
+            if limit is not None:
+                if self.convert_units is not None:
+                    to_mg = self.convert_units.get(metal, False)
+                else:
+                    to_mg = bool((values > 100 * limit).any())
+                if to_mg:
+                    values = values / 1000
+            acc = self.metals.setdefault(metal, {"count": 0, "sum": 0.0, "min": np.nan, "max": np.nan,
+                                                 "exceedances": 0 if limit is not None else None})
+            if not len(values):
+                continue
+            acc["count"] += len(values)
+            acc["sum"] += float(values.sum())
+            acc["min"] = np.fmin(acc["min"], values.min())
+            acc["max"] = np.fmax(acc["max"], values.max())
+            if limit is not None:
+                acc["exceedances"] += int(np.count_nonzero(values > limit))
+        return self
+
+    def result(self):
+        hmpi = np.concatenate(self.hmpi) if self.hmpi else np.empty(0)
+        hmpi = hmpi[np.isfinite(hmpi)]
+        if len(hmpi):
+            counts, edges = np.histogram(hmpi, bins=HMPI_HISTOGRAM_BINS)
+            percentiles = np.percentile(hmpi, HMPI_PERCENTILES)
+            # 0 for values up to the first bound, 1 up to the second, ...
+            classes = np.bincount(np.digitize(hmpi, [b for _, b in POLLUTION_CLASSES[:-1]], right=True),
+                                  minlength=len(POLLUTION_CLASSES))
+            hmpi_stats = {
+                "count": int(len(hmpi)),
+                "min": float(hmpi.min()),
+                "max": float(hmpi.max()),
+                "mean": float(hmpi.mean()),
+                "std": float(hmpi.std()),
+                "percentiles": {f"p{q}": float(v) for q, v in zip(HMPI_PERCENTILES, percentiles)},
+                "histogram": {"edges": edges.tolist(), "counts": counts.tolist()},
+            }
+        else:
+            classes = np.zeros(len(POLLUTION_CLASSES), dtype=int)
+            hmpi_stats = {"count": 0, "min": None, "max": None, "mean": None, "std": None,
+                          "percentiles": {f"p{q}": None for q in HMPI_PERCENTILES},
+                          "histogram": {"edges": [], "counts": []}}
+
+        class_counts = {name: int(n) for (name, _), n in zip(POLLUTION_CLASSES, classes)}
+        class_counts["unclassified"] = self.rows - int(len(hmpi))
+        metals = {}
+        for metal, acc in self.metals.items():
+            count = acc["count"]
+            exceedances = acc["exceedances"]
+            metals[metal] = {
+                "count": count,
+                "min": _float_or_none(acc["min"]),
+                "mean": acc["sum"] / count if count else None,
+                "max": _float_or_none(acc["max"]),
+                "limit": STANDARD_LIMITS.get(metal),
+                "exceedances": exceedances,
+                "exceedance_rate": exceedances / count if count and exceedances is not None else None,
+            }
+        return {
+            "version": STATS_VERSION,
+            "rows": self.rows,
+            "unit": "mg/L",
+            "hmpi": hmpi_stats,
+            "classes": class_counts,
+            "metals": metals,
+        }
+
+
+def dataset_stats(df_hmpi, merged_cols, convert_units=None):
+    """DatasetStats.result() for a dataset processed in one piece"""
+    return DatasetStats(convert_units).add(df_hmpi, merged_cols).result()
+
+
+def stats_from_features(features):
+    """dataset_stats rebuilt from stored GeoJSON features, for datasets ingested before stats existed"""
+    columns = features_to_columns(features)
+    df = pd.DataFrame({"HMPI": columns["HMPI"], **columns["metals"]}, dtype=float)
+    return dataset_stats(df, {metal: metal for metal in columns["metals"]})
+
+
+def pipeline_params(metal_min, convert_units, strategy="half", fill_values=None):
+    """
+    The choices the pipeline makes from a whole dataset, in storable form:
+    the missing-value strategy, the per-metal minimum behind the 'half' fill
+    (or the 'mean'/'median' fill values) and the μg/L → mg/L decision. Kept
+    with the dataset so appended rows are processed the same way.
+    """
+    params = {
+        "strategy": strategy,
+        "metal_min": {metal: _float_or_none(value) for metal, value in metal_min.items()},
+        "convert_units": {metal: bool(value) for metal, value in convert_units.items()},
+    }
+    if fill_values is not None:
+        params["fill_values"] = {metal: _float_or_none(value) for metal, value in fill_values.items()}
+    return params
+
+
+def dataframe_pipeline_params(df, metal_cols=None, strategy="half"):
+    """pipeline_params of a dataset run through run_lean_pipeline in one piece"""
+    if metal_cols is None:
+        metal_cols = detect_metal_columns(df)
+    metals, conc = build_concentration_matrix(df, metal_cols)
+    return matrix_pipeline_params(conc, metals, strategy)
+
+
+def matrix_pipeline_params(conc, metals, strategy="half"):
+    """pipeline_params from a metals x rows concentration matrix, before fill_missing_matrix"""
+    fill, fill_values = {"mean": np.nanmean, "median": np.nanmedian}.get(strategy), None
+    if conc.shape[1]:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            metal_min, metal_max = np.nanmin(conc, axis=1), np.nanmax(conc, axis=1)
+            if fill is not None:
+                fill_values = dict(zip(metals, fill(conc, axis=1)))
+    else:
+        metal_min = metal_max = np.full(len(metals), np.nan)
+    # As in scan_csv_statistics: the 'half' fill never exceeds the minimum,
+    # so the unit heuristic only depends on the column maximum
+    return pipeline_params(
+        dict(zip(metals, metal_min)),
+        {metal: high > 100 * STANDARD_LIMITS[metal] for metal, high in zip(metals, metal_max)
+         if metal in STANDARD_LIMITS},
+        strategy,
+        fill_values,
+    )
+
+
+def pipeline_params_from_features(features):
+    """
+    pipeline_params recovered from stored features, for datasets saved before
+    they were kept. The stored concentrations are already filled, so a metal
+    that had missing readings comes out at half its original minimum.
+    """
+    columns = features_to_columns(features)
+    df = pd.DataFrame(columns["metals"], dtype=float)
+    return dataframe_pipeline_params(df, {metal: [metal] for metal in columns["metals"]})
+
+
+def dataset_fields(df_hmpi, merged_cols, params):
+    """Fields stored on a dataset document at ingest, besides its features; params from run_lean_pipeline"""
+    return {
+        "stats": dataset_stats(df_hmpi, merged_cols),
+        "pipeline_params": params,
+    }
+
+
+def run_append_pipeline(df, params):
+    """
+    Run rows appended to a stored dataset through run_lean_pipeline with the
+    dataset's pipeline_params instead of values derived from these rows alone.
+    Metals the dataset did not have get their params from the new rows.
+    Returns (df_hmpi, merged_cols, params), params including any new metals.
+    """
+    # Datasets stored before the strategy was recorded all used 'half'
+    strategy = params.get("strategy", "half")
+    metal_cols = detect_metal_columns(df)
+    new_metals = {metal: cols for metal, cols in metal_cols.items() if metal not in params["metal_min"]}
+    if new_metals:
+        added = dataframe_pipeline_params(df, new_metals, strategy)
+        params = {
+            **params,
+            "metal_min": {**params["metal_min"], **added["metal_min"]},
+            "convert_units": {**params["convert_units"], **added["convert_units"]},
+        }
+        if "fill_values" in added:
+            params["fill_values"] = {**params.get("fill_values", {}), **added["fill_values"]}
+    # 0.5 * detection limit == 0.5 * the dataset's minimum for the 'half' fill
+    df_hmpi, merged_cols = run_lean_pipeline(
+        df,
+        metal_cols=metal_cols,
+        strategy=strategy,
+        detection_limits=params["metal_min"],
+        convert_units=params["convert_units"],
+        fill_values=params.get("fill_values"),
+    )
+    return df_hmpi, merged_cols, params
+
+
+# Flat export layout: one column per metal plus lon/lat
+EXPORT_COLUMNS = ["Sample_ID", "Longitude", "Latitude", "latitudeandlongitudepresent",
+                  "no_of_metals", "HMPI"] + list(METAL_KEYWORDS)
+
+
+def flatten_feature(feature):
+    """Turn a GeoJSON feature into a row of EXPORT_COLUMNS values"""
+    coordinates = (feature.get("geometry") or {}).get("coordinates") or [None, None]
+    metal_conc = feature.get("all_metal_conc") or {}
+    row = [
+        feature.get("Sample_ID"),
+        coordinates[0],
+        coordinates[1],
+        feature.get("latitudeandlongitudepresent"),
+        feature.get("no_of_metals"),
+        feature.get("HMPI"),
+    ] + [metal_conc.get(metal) for metal in METAL_KEYWORDS]
+    # NaN is exported as an empty/null value
+    return [None if isinstance(v, float) and v != v else v for v in row]
+
+
+def export_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in batches:
+        writer.writerows(flatten_feature(f) for f in batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate(0)
+    yield buffer.getvalue().encode()
+
+
+def export_gzip(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31 selects the gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_ndjson(batches):
+    for batch in batches:
+        yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, flatten_feature(f)))) + "\n" for f in batch).encode()
+
+
+class _ByteSink(io.RawIOBase):
+    """Write-only file that hands back what was written since the last drain()"""
+
+    def __init__(self):
+        self.pending = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.pending.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.pending)
+        self.pending = []
+        return data
+
+
+def export_parquet(batches):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [("Sample_ID", pa.string()), ("Longitude", pa.float64()), ("Latitude", pa.float64()),
+         ("latitudeandlongitudepresent", pa.bool_()), ("no_of_metals", pa.int64()), ("HMPI", pa.float64())]
+        + [(metal, pa.float64()) for metal in METAL_KEYWORDS]
+    )
+    sink = _ByteSink()
+    writer = pq.ParquetWriter(sink, schema)
+    # Each stored chunk becomes one row group
+    for batch in batches:
+        if not batch:
+            continue
+        columns = list(zip(*(flatten_feature(f) for f in batch)))
+        columns[0] = [None if v is None else str(v) for v in columns[0]]
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+            schema=schema
+        ))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def features_to_columns(features):
+    """
+    Struct-of-arrays form of a feature list: one array per field and per
+    metal, without the per-feature keys that dominate GeoJSON payloads.
+    Metals no sample reports are left out.
+    """
+    rows = [flatten_feature(f) for f in features]
+    columns = dict(zip(EXPORT_COLUMNS, map(list, zip(*rows)))) if rows else {c: [] for c in EXPORT_COLUMNS}
+    present = np.array(columns["latitudeandlongitudepresent"], dtype=bool)
+    return {
+        "count": len(rows),
+        "Sample_ID": columns["Sample_ID"],
+        "lon": columns["Longitude"],
+        "lat": columns["Latitude"],
+        "HMPI": columns["HMPI"],
+        "no_of_metals": columns["no_of_metals"],
+        "metals": {m: columns[m] for m in METAL_KEYWORDS if any(v is not None for v in columns[m])},
+        # Bit i (least significant first) is set when sample i has coordinates,
+        # the same layout as an Arrow validity buffer
+        "has_location": base64.b64encode(np.packbits(present, bitorder="little")).decode(),
+    }
+
+
+def features_to_arrow(features, fields):
+    """Arrow IPC stream of the columnar layout; `fields` travel as JSON schema metadata"""
+    import pyarrow as pa
+
+    columns = features_to_columns(features)
+    arrays = {
+        "Sample_ID": pa.array([None if v is None else str(v) for v in columns["Sample_ID"]], type=pa.string()),
+        "lon": pa.array(columns["lon"], type=pa.float64()),
+        "lat": pa.array(columns["lat"], type=pa.float64()),
+        "HMPI": pa.array(columns["HMPI"], type=pa.float64()),
+        "no_of_metals": pa.array(columns["no_of_metals"], type=pa.int32()),
+        **{m: pa.array(values, type=pa.float64()) for m, values in columns["metals"].items()},
+    }
+    table = pa.table(arrays).replace_schema_metadata({"aquascan": json.dumps(fields, default=str)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def run_pipeline_on_bytes(data, filename, sheet=None):
+    """
+    Process-pool entry point: run the HMPI pipeline on the raw bytes of an
+    upload. Returns (features, row_count, dataset_fields).
+    """
+    df = load_file(FileStorage(io.BytesIO(data), filename=filename), sheet)
+    df_hmpi, merged_cols, params = run_lean_pipeline(df, return_params=True)
+    return build_geojson_features(df_hmpi, merged_cols), len(df), dataset_fields(df_hmpi, merged_cols, params)
+
+
+def prepare_geojson(df, geo_cols):
+    if geo_cols.get('Latitude') and geo_cols.get('Longitude'):
+        df_geo = df.copy()
+        df_geo['geometry'] = df_geo.apply(
+            lambda row: {"type": "Point", "coordinates": [row[geo_cols['Longitude']], row[geo_cols['Latitude']]]}
+            if pd.notna(row[geo_cols['Longitude']]) and pd.notna(row[geo_cols['Latitude']])
+            else None, axis=1)
+        return df_geo
+    return None
+
+
+def generate_sample_ids(n):
+    """Generate n random UUID4 strings in one batch"""
+    raw = np.frombuffer(os.urandom(16 * n), dtype=np.uint8).reshape(n, 16).copy()
+    # Set the version (4) and RFC 4122 variant bits, as uuid.uuid4() does
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80
+    hex_ids = raw.tobytes().hex()
+    return [
+        f"{h[0:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}"
+        for h in (hex_ids[i:i + 32] for i in range(0, 32 * n, 32))
+    ]
+
+
+@timed_stage("features")
+def build_geojson_features(df_hmpi, merged_cols):
+    """
+    Build the GeoJSON feature list for an HMPI dataframe.
+    Works column by column on whole arrays instead of iterating rows.
+    """
+    n = len(df_hmpi)
+    valid_metals_for_geo = [m for m in merged_cols if m in df_hmpi.columns]
+
+    def column_or_none(col):
+        return df_hmpi[col].tolist() if col in df_hmpi.columns else [None] * n
+
+    # NaN masks and metal counts for every row at once
+    metal_values = [df_hmpi[m].tolist() for m in valid_metals_for_geo]
+    metal_present = [df_hmpi[m].notna().tolist() for m in valid_metals_for_geo]
+    if valid_metals_for_geo:
+        no_of_metals = np.sum(metal_present, axis=0).tolist()
+        metal_concs = [
+            {m: v for m, v, ok in zip(valid_metals_for_geo, values, present) if ok}
+            for values, present in zip(zip(*metal_values), zip(*metal_present))
+        ]
+    else:
+        no_of_metals = [0] * n
+        metal_concs = [{} for _ in range(n)]
+
+    lon = column_or_none("Longitude")
+    lat = column_or_none("Latitude")
+    if "Latitude" in df_hmpi.columns and "Longitude" in df_hmpi.columns:
+        latlon_flags = (df_hmpi["Latitude"].notna() & df_hmpi["Longitude"].notna()).tolist()
+    else:
+        latlon_flags = [False] * n
+
+    if "Sample_ID" in df_hmpi.columns:
+        sample_ids = df_hmpi["Sample_ID"].tolist()
+    else:
+        sample_ids = generate_sample_ids(n)
+
+    hmpi = column_or_none("HMPI")
+
+    return [
+        {
+            "Sample_ID": sample_id,
+            "no_of_metals": count,
+            "all_metal_conc": metal_conc,
+            "geometry": {
+                "type": "Point",
+                "coordinates": [x, y]
+            },
+            "latitudeandlongitudepresent": flag,
+            "HMPI": h
+        }
+        for sample_id, count, metal_conc, x, y, flag, h
+        in zip(sample_ids, no_of_metals, metal_concs, lon, lat, latlon_flags, hmpi)
+    ]
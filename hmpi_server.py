@@ -0,0 +1,1233 @@
+"""
+Server code shared by the web apps (app.py, AquaScan_prototype/proj.py):
+the JSON provider, request metrics and response compression, the
+per-process MongoDB client, chunked feature storage, ?format= responses,
+map-tile clusters, the upload result cache and the background job pool.
+
+The apps call init_app() on their Flask app. connect_mongo() replaces the
+collection handles after a fork, so the apps read them from this module
+(server.samples_collection, ...) rather than importing them by name.
+"""
+import os
+import io
+import gzip
+import decimal
+import uuid
+import hashlib
+import threading
+import time
+import multiprocessing
+import bisect
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+from flask import Response, current_app, g, has_request_context, jsonify, request, stream_with_context
+from flask.json.provider import JSONProvider
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+from werkzeug.http import http_date
+
+from hmpi_pipeline import (
+    PIPELINE_FINGERPRINT, STANDARD_LIMITS, STANDARD_PROFILES, DatasetStats, allowed_file,
+    compute_hmpi_profiles, feature_chunk_docs, feature_point_docs, features_to_arrow, features_to_columns,
+    hmpi_summary, install_instrumentation, iter_csv_feature_chunks, pipeline_params,
+    pipeline_params_from_features, run_pipeline_on_bytes, stage, stats_from_features, timed_stage,
+    valid_coordinates,
+)
+
+# Optional speedups: orjson for encoding responses, brotli for compressing them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class FastJSONProvider(JSONProvider):
+    """
+    orjson-backed JSON provider. NumPy arrays and scalars are serialized
+    natively and NaN/Infinity become null, so responses are always valid JSON.
+    """
+
+    @staticmethod
+    def default(o):
+        if o is pd.NaT or o is pd.NA:
+            return None
+        if isinstance(o, datetime):
+            # Same HTTP date format as Flask's default provider
+            return http_date(o)
+        if isinstance(o, np.generic):
+            return o.item()
+        if isinstance(o, (ObjectId, uuid.UUID, decimal.Decimal)):
+            return str(o)
+        raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+    def encode(self, obj):
+        return orjson.dumps(
+            obj,
+            default=self.default,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        )
+
+    def dumps(self, obj, **kwargs):
+        return self.encode(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes to the response without a round trip through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.encode(obj), mimetype="application/json")
+
+
+# "orjson" (default when installed) or "flask" for Flask's built-in provider
+JSON_PROVIDER = os.environ.get("JSON_PROVIDER", "orjson")
+
+# Per-request stage timing, reported in the Server-Timing header and
+# aggregated per worker for GET /metrics (Prometheus text format)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_metrics_lock = threading.Lock()
+# (metric, labels) -> [count per bucket..., count above the last bucket, sum]
+_histograms = {}
+# (metric, labels) -> value
+_counters = {}
+
+
+def observe(metric, labels, value):
+    key = (metric, labels)
+    with _metrics_lock:
+        series = _histograms.get(key)
+        if series is None:
+            series = _histograms[key] = [0] * (len(METRICS_BUCKETS) + 2)
+        series[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        series[-1] += value
+
+
+def inc_counter(metric, labels, value=1):
+    key = (metric, labels)
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+@contextmanager
+def request_stage(name):
+    """Time a block as one stage of the current request; a no-op outside requests"""
+    if not METRICS_ENABLED or not has_request_context():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.setdefault("stages", []).append((name, time.perf_counter() - start))
+
+
+def count_request_dataset(df):
+    """Record the size of a parsed upload for the current request"""
+    if METRICS_ENABLED and has_request_context():
+        g.dataset_rows = g.get("dataset_rows", 0) + len(df)
+        g.dataset_columns = g.get("dataset_columns", 0) + len(df.columns)
+
+
+# stage()/timed_stage() in hmpi_pipeline and below report to the request
+install_instrumentation(stage=request_stage, count_dataset=count_request_dataset)
+
+
+def start_request_timer():
+    global first_request_at
+    g.request_started = time.perf_counter()
+    if first_request_at is None:
+        first_request_at = time.time()
+
+
+def record_request_metrics(response):
+    if not METRICS_ENABLED or "request_started" not in g:
+        return response
+    endpoint = request.endpoint or "unmatched"
+    elapsed = time.perf_counter() - g.request_started
+    observe("aquascan_request_seconds", (("endpoint", endpoint),), elapsed)
+    inc_counter("aquascan_requests_total", (("endpoint", endpoint), ("status", str(response.status_code))))
+
+    stages = {}
+    for name, seconds in g.get("stages", ()):
+        stages[name] = stages.get(name, 0.0) + seconds
+    for name, seconds in stages.items():
+        observe("aquascan_stage_seconds", (("endpoint", endpoint), ("stage", name)), seconds)
+    if "dataset_rows" in g:
+        inc_counter("aquascan_rows_processed_total", (("endpoint", endpoint),), g.dataset_rows)
+        inc_counter("aquascan_columns_processed_total", (("endpoint", endpoint),), g.dataset_columns)
+        inc_counter("aquascan_upload_bytes_total", (("endpoint", endpoint),), request.content_length or 0)
+
+    timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages.items()]
+    timings.append(f"total;dur={elapsed * 1000:.1f}")
+    response.headers["Server-Timing"] = ", ".join(timings)
+    return response
+
+
+def format_labels(labels, extra=()):
+    pairs = [f'{k}="{v}"' for k, v in labels + extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render_metrics(extra_counters=()):
+    """
+    Prometheus text exposition of this worker's histograms and counters.
+    Each worker process counts on its own and a scrape reaches whichever one
+    accepts it, so every series carries a worker="<pid>" label: series from
+    different workers never overwrite each other, and sum without (worker)
+    gives the totals.
+    """
+    with _metrics_lock:
+        histograms = {k: list(v) for k, v in _histograms.items()}
+        counters = dict(_counters)
+    counters.update(extra_counters)
+    worker = (("worker", str(os.getpid())),)
+
+    lines = []
+    for metric in sorted({m for m, _ in histograms}):
+        lines.append(f"# TYPE {metric} histogram")
+        for (m, labels), series in sorted(histograms.items()):
+            if m != metric:
+                continue
+            labels = labels + worker
+            cumulative = 0
+            for bound, n in zip(METRICS_BUCKETS, series):
+                cumulative += n
+                lines.append(f"{metric}_bucket{format_labels(labels, (('le', repr(bound)),))} {cumulative}")
+            total = cumulative + series[-2]
+            lines.append(f"{metric}_bucket{format_labels(labels, (('le', '+Inf'),))} {total}")
+            lines.append(f"{metric}_sum{format_labels(labels)} {series[-1]}")
+            lines.append(f"{metric}_count{format_labels(labels)} {total}")
+    for metric in sorted({m for m, _ in counters}):
+        lines.append(f"# TYPE {metric} counter")
+        for (m, labels), value in sorted(counters.items()):
+            if m == metric:
+                lines.append(f"{metric}{format_labels(labels + worker)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Responses at least this large are compressed when the client accepts
+# br or gzip; streamed responses are left alone
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+# Level 1 for both codecs: most of the size win for a fraction of the CPU
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", 1))
+COMPRESS_MIMETYPES = {"application/json", "text/csv", "application/x-ndjson",
+                      "application/vnd.apache.arrow.stream"}
+
+
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.content_length is not None and response.content_length < COMPRESS_MIN_BYTES:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        with stage("compress"):
+            body, encoding = brotli.compress(response.get_data(), quality=min(COMPRESS_LEVEL, 11)), "br"
+    elif accepted["gzip"]:
+        with stage("compress"):
+            body, encoding = gzip.compress(response.get_data(), compresslevel=COMPRESS_LEVEL), "gzip"
+    else:
+        return response
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+# MongoDB connection - use environment variable or default to localhost
+MONGODB_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017/")
+# Per-process connection pool and timeouts
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", 60000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000))
+
+
+class PoolCounters(ConnectionPoolListener):
+    """Connection pool activity of this process's MongoClient, for /ready"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.open = self.in_use = self.created = self.checkout_failures = self.clears = 0
+
+    def connection_created(self, event):
+        self.open += 1
+        self.created += 1
+
+    def connection_closed(self, event):
+        self.open -= 1
+
+    def connection_checked_out(self, event):
+        self.in_use += 1
+
+    def connection_checked_in(self, event):
+        self.in_use -= 1
+
+    def connection_check_out_failed(self, event):
+        self.checkout_failures += 1
+
+    def pool_cleared(self, event):
+        self.clears += 1
+
+    # Not reported
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+mongo_pool = PoolCounters()
+
+
+def connect_mongo():
+    """
+    (Re)create the MongoDB client and collection handles. connect=False
+    defers connecting to the first query, so importing this module opens no
+    sockets and every process builds its own pool.
+    """
+    global client, db, samples_collection, result_cache, feature_chunks, jobs_collection, feature_points
+    mongo_pool.reset()
+    client = MongoClient(
+        MONGODB_URI,
+        connect=False,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        event_listeners=[mongo_pool],
+    )
+    db = client['heavy_metal_db']
+    samples_collection = db['samples']
+    result_cache = db['result_cache']
+    feature_chunks = db['feature_chunks']
+    jobs_collection = db['jobs']
+    feature_points = db['feature_points']
+
+
+connect_mongo()
+
+# When and how this process came up, for /health and the startup benchmark
+process_started_at = time.time()
+first_request_at = None
+
+
+def after_fork():
+    """A forked child (e.g. a gunicorn worker under --preload) must not share its parent's client"""
+    global process_started_at, first_request_at
+    process_started_at, first_request_at = time.time(), None
+    connect_mongo()
+
+
+os.register_at_fork(after_in_child=after_fork)
+
+_indexes_ready = False
+
+
+def ensure_indexes():
+    """Create the indexes our queries rely on, once per worker"""
+    global _indexes_ready
+    # Health checks must answer even while MongoDB is down
+    if _indexes_ready or request.endpoint in ("health", "ready"):
+        return
+    try:
+        feature_chunks.create_index([("dataset_id", 1), ("seq", 1)], unique=True)
+        result_cache.create_index("last_used_at")
+        feature_points.create_index([("dataset_id", 1), ("location", "2dsphere")])
+        # /history pages and /permissions' latest-upload lookup
+        db.uploads.create_index([("user_id", 1), ("created_at", -1), ("_id", -1)])
+        _indexes_ready = True
+    except Exception:
+        # Retried on the next request; static files still get served
+        import traceback
+        traceback.print_exc()
+
+
+# Processed uploads remembered by content hash, shared by all workers via MongoDB
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 1000))
+result_cache_counters = {"hits": 0, "misses": 0}
+
+# Features per chunk document, well below MongoDB's 16 MB document limit
+FEATURE_CHUNK_SIZE = int(os.environ.get("FEATURE_CHUNK_SIZE", 5000))
+
+# Process pool shared by /process?async=1 jobs and /upload/batch, and the
+# per-worker cap on queued async jobs
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", os.cpu_count() or 2))
+JOB_MAX_QUEUED = int(os.environ.get("JOB_MAX_QUEUED", 8))
+_job_pool = None
+_job_pool_lock = threading.Lock()
+_job_slots = threading.BoundedSemaphore(JOB_MAX_QUEUED)
+
+# Map tiles: clusters per tile side, the zoom from which /tiles serves
+# individual points, and how many datasets, and how many bytes of their
+# points and cluster levels, each worker keeps in memory
+CLUSTER_GRID = int(os.environ.get("CLUSTER_GRID", 8))
+CLUSTER_MAX_ZOOM = int(os.environ.get("CLUSTER_MAX_ZOOM", 14))
+CLUSTER_CACHE_SIZE = int(os.environ.get("CLUSTER_CACHE_SIZE", 16))
+CLUSTER_CACHE_MAX_BYTES = int(os.environ.get("CLUSTER_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+TILE_MAX_ZOOM = 22
+_cluster_indexes = OrderedDict()
+_cluster_indexes_lock = threading.Lock()
+cluster_cache_counters = {"hits": 0, "misses": 0}
+
+
+def stream_process_response(file, stats, doc_fields=None, extra_payload=None):
+    """
+    Streaming variant of the /process response for large CSV uploads.
+    Each chunk's features are stored in MongoDB and written to the response
+    as soon as they are built, so only one chunk is held in memory at a time.
+    """
+    # Take ownership of the upload stream: the request closes its files when
+    # the view returns, before the response body has been generated
+    stream, file.stream = file.stream, io.BytesIO()
+
+    doc_id = str(uuid.uuid4())
+    samples_collection.insert_one({
+        "_id": doc_id,
+        "created_at": datetime.utcnow(),
+        "feature_count": 0,
+        "chunk_size": FEATURE_CHUNK_SIZE,
+        "pipeline_params": pipeline_params(stats["metal_min"], stats["convert_units"]),
+        **(doc_fields or {}),
+    })
+
+    def generate():
+        yield f'{{"file_id": {current_app.json.dumps(doc_id)}, "GeoJSON": ['
+        sep = ""
+        seq, pending, count = 0, [], 0
+        summary = DatasetStats(stats["convert_units"])
+        try:
+            for features in iter_csv_feature_chunks(stream, stats, summary=summary):
+                if not features:
+                    continue
+                # Only whole chunks are written until the end, so chunk k
+                # always starts at feature k * FEATURE_CHUNK_SIZE
+                pending.extend(features)
+                full = len(pending) - len(pending) % FEATURE_CHUNK_SIZE
+                seq = insert_feature_chunks(doc_id, pending[:full], FEATURE_CHUNK_SIZE, seq)
+                pending = pending[full:]
+                count += len(features)
+                yield sep + ", ".join(current_app.json.dumps(f) for f in features)
+                sep = ", "
+            insert_feature_chunks(doc_id, pending, FEATURE_CHUNK_SIZE, seq)
+        finally:
+            stream.close()
+        samples_collection.update_one({"_id": doc_id}, {"$set": {"feature_count": count, "stats": summary.result()}})
+        yield "]"
+        for key, value in (extra_payload or {}).items():
+            yield f", {current_app.json.dumps(key)}: {current_app.json.dumps(value)}"
+        yield "}"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def bbox_geometry(min_lon, min_lat, max_lon, max_lat):
+    """GeoJSON polygon for a lon/lat box, usable with $geoWithin"""
+    return {
+        "type": "Polygon",
+        "coordinates": [[[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat],
+                         [min_lon, max_lat], [min_lon, min_lat]]],
+        # Counter-clockwise winding, so boxes larger than a hemisphere work too
+        "crs": {"type": "name", "properties": {"name": "urn:x-mongodb:crs:strictwinding:EPSG:4326"}},
+    }
+
+
+def parse_floats(value, count):
+    values = [float(v) for v in value.split(",")]
+    if len(values) != count:
+        raise ValueError(f"expected {count} comma-separated numbers")
+    return values
+
+
+def valid_lonlat(lon, lat):
+    """True for WGS84 degrees MongoDB accepts in a 2dsphere query"""
+    return -180 <= lon <= 180 and -90 <= lat <= 90
+
+
+def insert_feature_chunks(dataset_id, features, chunk_size, first_seq=0):
+    """Store features as fixed-size chunk documents, returning the next free seq"""
+    docs = feature_chunk_docs(dataset_id, features, chunk_size, first_seq)
+    if docs:
+        feature_chunks.insert_many(docs)
+    points = feature_point_docs(dataset_id, features, first_seq * chunk_size)
+    if points:
+        feature_points.insert_many(points)
+    return first_seq + len(docs)
+
+
+def truncate_feature_chunks(doc):
+    """
+    Drop whatever a chunked dataset stores past its first doc["feature_count"]
+    features, e.g. left by an append that failed. Returns the seq of the last,
+    partial chunk and how many features it keeps.
+    """
+    dataset_id, chunk_size, count = doc["_id"], doc["chunk_size"], doc["feature_count"]
+    seq, used = divmod(count, chunk_size)
+    feature_chunks.delete_many({"dataset_id": dataset_id, "seq": {"$gt" if used else "$gte": seq}})
+    feature_points.delete_many({"dataset_id": dataset_id, "idx": {"$gte": count}})
+    if used:
+        feature_chunks.update_one({"dataset_id": dataset_id, "seq": seq},
+                                  {"$push": {"features": {"$each": [], "$slice": used}}})
+    return seq, used
+
+
+def append_feature_chunks(doc, features):
+    """
+    Store features after the first doc["feature_count"] of a chunked dataset.
+    The last, partial chunk is topped up first, so chunk k still starts at
+    feature k * chunk_size. Whatever a failed earlier append left past
+    feature_count is dropped.
+    """
+    dataset_id, chunk_size, count = doc["_id"], doc["chunk_size"], doc["feature_count"]
+    seq, used = truncate_feature_chunks(doc)
+    if used:
+        chunk = {"dataset_id": dataset_id, "seq": seq}
+        head, features = features[:chunk_size - used], features[chunk_size - used:]
+        if head:
+            feature_chunks.update_one(chunk, {"$push": {"features": {"$each": head}}})
+            points = feature_point_docs(dataset_id, head, count)
+            if points:
+                feature_points.insert_many(points)
+        seq += 1
+    return insert_feature_chunks(dataset_id, features, chunk_size, seq)
+
+
+def copy_dataset(doc, dataset_id, fields=None):
+    """
+    Copy the first doc["feature_count"] features of a chunked dataset, chunks
+    and points, to `dataset_id`. Returns the document for the copy, which is
+    not inserted: nothing refers to the copy until the caller stores it.
+    """
+    count, chunk_size = doc["feature_count"], doc["chunk_size"]
+    chunks = feature_chunks.find({"dataset_id": doc["_id"], "seq": {"$lt": -(-count // chunk_size)}})
+    for chunk in chunks.sort("seq", 1):
+        feature_chunks.insert_one({
+            "dataset_id": dataset_id,
+            "seq": chunk["seq"],
+            "features": chunk["features"][:count - chunk["seq"] * chunk_size],
+        })
+    batch = []
+    for point in feature_points.find({"dataset_id": doc["_id"], "idx": {"$lt": count}}, {"_id": 0}):
+        batch.append({**point, "dataset_id": dataset_id})
+        if len(batch) == chunk_size:
+            feature_points.insert_many(batch)
+            batch = []
+    if batch:
+        feature_points.insert_many(batch)
+    copy = {key: value for key, value in doc.items() if key not in ("append_started_at", "shared", "updated_at")}
+    return {**copy, "_id": dataset_id, "created_at": datetime.utcnow(), "copied_from": doc["_id"], **(fields or {})}
+
+
+def commit_append(doc, features, fields, row_count, copy_fields=None):
+    """
+    Store an append's features after the first doc["feature_count"] of a
+    chunked dataset and $set `fields` on it; returns the id it was stored
+    under. A dataset that result cache hits also handed to other clients is
+    left as it is: the append goes to a copy under a new id, with
+    `copy_fields`. If storing fails, what was written is removed again.
+    """
+    copy_id = str(uuid.uuid4()) if doc.get("shared") else None
+    try:
+        if copy_id is None:
+            append_feature_chunks(doc, features)
+            samples_collection.update_one({"_id": doc["_id"]}, {
+                "$set": fields,
+                **({"$inc": {"row_count": row_count}} if "row_count" in doc else {}),
+            })
+        else:
+            copy = copy_dataset(doc, copy_id, copy_fields)
+            append_feature_chunks(copy, features)
+            copy.update(fields)
+            if "row_count" in copy:
+                copy["row_count"] += row_count
+            samples_collection.insert_one(copy)
+    except Exception:
+        if copy_id is None:
+            # Keep what the stored feature_count says, whether or not the update went through
+            truncate_feature_chunks(samples_collection.find_one(
+                {"_id": doc["_id"]}, {"feature_count": 1, "chunk_size": 1}))
+        else:
+            feature_chunks.delete_many({"dataset_id": copy_id})
+            feature_points.delete_many({"dataset_id": copy_id})
+        raise
+    if copy_id is None:
+        # Re-uploading the original file must not return the extended dataset
+        result_cache.delete_many({"file_id": doc["_id"]})
+    return copy_id or doc["_id"]
+
+
+@timed_stage("store")
+def store_features(collection, doc, features):
+    """
+    Insert a dataset document, keeping its features in feature_chunks instead
+    of inline. Documents without the pipeline's dataset_fields get their
+    stats rebuilt from the features.
+    """
+    doc["feature_count"] = len(features)
+    doc["chunk_size"] = FEATURE_CHUNK_SIZE
+    doc["hmpi_stats"] = hmpi_summary(features)
+    if "stats" not in doc:
+        doc["stats"] = stats_from_features(features)
+    dataset_id = collection.insert_one(doc).inserted_id
+    insert_feature_chunks(dataset_id, features, doc["chunk_size"])
+    return dataset_id
+
+
+@timed_stage("store")
+def store_features_many(collection, docs, feature_lists):
+    """Batch form of store_features: one insert_many for the documents and one for all their chunks"""
+    chunk_docs, point_docs = [], []
+    for doc, features in zip(docs, feature_lists):
+        doc.setdefault("_id", ObjectId())
+        doc["feature_count"] = len(features)
+        doc["chunk_size"] = FEATURE_CHUNK_SIZE
+        doc["hmpi_stats"] = hmpi_summary(features)
+        if "stats" not in doc:
+            doc["stats"] = stats_from_features(features)
+        chunk_docs.extend(feature_chunk_docs(doc["_id"], features, FEATURE_CHUNK_SIZE))
+        point_docs.extend(feature_point_docs(doc["_id"], features))
+    if docs:
+        collection.insert_many(docs)
+    if chunk_docs:
+        feature_chunks.insert_many(chunk_docs)
+    if point_docs:
+        feature_points.insert_many(point_docs)
+    return [doc["_id"] for doc in docs]
+
+
+def stored_dataset_fields(doc):
+    """The dataset_fields of a stored dataset, to copy onto a new document for the same data"""
+    return {key: doc[key] for key in ("stats", "pipeline_params") if key in doc}
+
+
+def store_dataset(cache_key, doc, features):
+    """
+    Store a newly processed upload in the samples collection and remember it
+    in the result cache. Returns the stored document.
+    """
+    doc = {"_id": str(uuid.uuid4()), "created_at": datetime.utcnow(), **doc}
+    store_features(samples_collection, doc, features)
+    store_cached_result(cache_key, doc["_id"], doc["row_count"])
+    return doc
+
+
+def upload_reference(doc, dataset):
+    """
+    Upload document for a stored dataset. The features are not copied: the
+    document records the dataset_id they are stored under.
+    """
+    if "GeoJSON" in dataset:
+        # Stored inline before chunked storage: nothing to point at
+        features = dataset["GeoJSON"]
+        return {**doc, "GeoJSON": features, "feature_count": len(features), "hmpi_stats": hmpi_summary(features),
+                **stored_dataset_fields(dataset)}
+    return {
+        **doc,
+        "dataset_id": dataset["_id"],
+        "feature_count": dataset["feature_count"],
+        "chunk_size": dataset["chunk_size"],
+        "hmpi_stats": dataset["hmpi_stats"] if "hmpi_stats" in dataset else hmpi_summary(load_features(dataset)),
+        **stored_dataset_fields(dataset),
+    }
+
+
+def feature_source_id(doc):
+    """Id a dataset's features are stored under: its own, or that of the dataset an upload references"""
+    return doc.get("dataset_id", doc["_id"])
+
+
+def feature_chunk_query(doc, after=0, limit=None):
+    """
+    Filter for the chunks holding features [after, after + limit) of a
+    chunked dataset, and the slice of their concatenation to keep
+    """
+    # Chunks past feature_count belong to an append still in progress (or one
+    # that failed), and an upload reference keeps only what the upload saw
+    end = doc["feature_count"] if limit is None else min(after + limit, doc["feature_count"])
+    chunk_size = doc["chunk_size"]
+    seq_range = {"$gte": after // chunk_size, "$lt": -(-end // chunk_size)}
+    first = seq_range["$gte"] * chunk_size
+    query = {"dataset_id": feature_source_id(doc), "seq": seq_range}
+    return query, slice(after - first, max(end - first, 0))
+
+
+def load_features(doc, after=0, limit=None):
+    """Return the dataset's features from position `after`, at most `limit` of them"""
+    if "GeoJSON" in doc:
+        # Stored inline before chunked storage
+        return doc["GeoJSON"][after:None if limit is None else after + limit]
+
+    query, keep = feature_chunk_query(doc, after, limit)
+    features = []
+    for chunk in feature_chunks.find(query, {"features": 1}).sort("seq", 1):
+        features.extend(chunk["features"])
+    return features[keep]
+
+
+def load_hmpi_values(doc):
+    """HMPI of every stored feature of a chunked dataset, in order, without reading the rest of the features"""
+    query, keep = feature_chunk_query(doc)
+    values = []
+    for chunk in feature_chunks.find(query, {"features.HMPI": 1}).sort("seq", 1):
+        values.extend(f.get("HMPI") for f in chunk["features"])
+    return np.array(values[keep], dtype=float)
+
+
+def iter_feature_batches(doc):
+    """Yield a dataset's features one stored chunk at a time"""
+    if "GeoJSON" in doc:
+        features = doc["GeoJSON"]
+        for start in range(0, len(features), FEATURE_CHUNK_SIZE):
+            yield features[start:start + FEATURE_CHUNK_SIZE]
+        return
+    query, _ = feature_chunk_query(doc)
+    remaining = doc["feature_count"]
+    for chunk in feature_chunks.find(query, {"features": 1}).sort("seq", 1):
+        features = chunk["features"][:remaining]
+        remaining -= len(features)
+        if features:
+            yield features
+
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "processed.csv"),
+    "csv.gz": ("application/gzip", "processed.csv.gz"),
+    "parquet": ("application/vnd.apache.parquet", "processed.parquet"),
+    "ndjson": ("application/x-ndjson", "processed.ndjson"),
+}
+
+
+# ?format= values accepted wherever features are returned
+FEATURE_FORMATS = ("geojson", "columnar", "arrow")
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+
+def check_feature_format():
+    """Error response for an unusable ?format=, or None"""
+    fmt = request.args.get("format", "geojson")
+    if fmt not in FEATURE_FORMATS:
+        return jsonify({"error": f"Unsupported format, use one of: {', '.join(FEATURE_FORMATS)}"}), 400
+    if fmt == "arrow":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return jsonify({"error": "Arrow responses require pyarrow"}), 501
+    return None
+
+
+@timed_stage("encode")
+def feature_response(features, fields, status=200):
+    """Respond with `fields` plus the features, laid out as ?format= asks"""
+    fmt = request.args.get("format", "geojson")
+    if fmt == "columnar":
+        return jsonify({**fields, "columns": features_to_columns(features)}), status
+    if fmt == "arrow":
+        return Response(features_to_arrow(features, fields), status=status, mimetype=ARROW_MIMETYPE)
+    return jsonify({**fields, "GeoJSON": features}), status
+
+
+def requested_standards(default=()):
+    """
+    STANDARD_PROFILES ids listed in ?standards=, or `default` without it.
+    Returns (standards, None), or (None, error response) for unknown ids.
+    """
+    value = request.args.get("standards")
+    standards = value.split(",") if value else list(default)
+    unknown = [s for s in standards if s not in STANDARD_PROFILES]
+    if unknown:
+        return None, (jsonify({"error": f"Unknown standards: {', '.join(unknown)}; "
+                                        f"use any of: {', '.join(STANDARD_PROFILES)}"}), 400)
+    return standards, None
+
+
+def standard_info(standard_id):
+    profile = STANDARD_PROFILES[standard_id]
+    return {"name": profile["name"], "version": profile["version"], "limits": profile["limits"]}
+
+
+def columns_hmpi_profiles(columns, standards, convert_units):
+    """HMPI of features_to_columns output against each of `standards`, one row per standard"""
+    metals = list(columns["metals"])
+    conc = np.array([columns["metals"][m] for m in metals], dtype=float).reshape(len(metals), columns["count"])
+    return compute_hmpi_profiles(conc, metals, [STANDARD_PROFILES[s] for s in standards], convert_units)
+
+
+def stored_hmpi_profiles(doc, features, standards):
+    """HMPI of all of a stored dataset's features against each of `standards`"""
+    # Stored concentrations are already filled; the μg/L decision is the dataset's
+    params = doc.get("pipeline_params") or pipeline_params_from_features(features)
+    return columns_hmpi_profiles(features_to_columns(features), standards, params["convert_units"])
+
+
+def standards_fields(standards, hmpi):
+    """Response fields for HMPI against each of `standards`, null where a standard has no limit for any metal"""
+    return {
+        "standards": {s: standard_info(s) for s in standards},
+        "HMPI_by_standard": {s: [None if v != v else v for v in np.asarray(row, dtype=float).tolist()]
+                             for s, row in zip(standards, hmpi)},
+    }
+
+
+def mercator_xy(lon, lat):
+    """Project WGS84 degrees onto the unit Web Mercator square, y pointing south"""
+    x = (np.asarray(lon, dtype=float) + 180.0) / 360.0
+    sin = np.sin(np.radians(np.clip(lat, -85.05112878, 85.05112878)))
+    y = 0.5 - np.log((1 + sin) / (1 - sin)) / (4 * np.pi)
+    return x, y
+
+
+def mercator_lonlat(x, y):
+    """Inverse of mercator_xy"""
+    lon = np.asarray(x, dtype=float) * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype=float)))))
+    return lon, lat
+
+
+def tile_bounds(z, x, y):
+    """(minLon, minLat, maxLon, maxLat) of a slippy-map tile"""
+    n = 1 << z
+    (min_lon, max_lon), (max_lat, min_lat) = mercator_lonlat([x / n, (x + 1) / n], [y / n, (y + 1) / n])
+    return float(min_lon), float(min_lat), float(max_lon), float(max_lat)
+
+
+def dominant_metal(metal_conc):
+    """Metal furthest above its standard limit, relative to that limit"""
+    best, best_ratio = None, None
+    for metal, conc in metal_conc.items():
+        limit = STANDARD_LIMITS.get(metal)
+        if limit is None or not isinstance(conc, (int, float)) or conc != conc:
+            continue
+        ratio = conc / limit
+        if best_ratio is None or ratio > best_ratio:
+            best, best_ratio = metal, ratio
+    return best
+
+
+def level_nbytes(level):
+    return sum(values.nbytes for values in level.values())
+
+
+class ClusterIndex:
+    """
+    Grid clusters over one dataset's points. Each zoom level is aggregated
+    once, on first use, into arrays sorted by tile so that serving a tile is
+    a binary search plus a slice.
+    """
+
+    def __init__(self, lon, lat, hmpi, dominant, metals):
+        self.x, self.y = mercator_xy(lon, lat)
+        self.hmpi = np.asarray(hmpi, dtype=float)
+        self.dominant = np.asarray(dominant, dtype=np.int64)
+        self.metals = metals
+        self.levels = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_batches(cls, batches):
+        lon, lat, hmpi, dominant, metals = [], [], [], [], []
+        metal_ids = {}
+        for features in batches:
+            for feature in features:
+                if not feature.get("latitudeandlongitudepresent"):
+                    continue
+                x, y = feature["geometry"]["coordinates"]
+                if not valid_coordinates(x, y):
+                    continue
+                lon.append(x)
+                lat.append(y)
+                h = feature.get("HMPI")
+                hmpi.append(h if isinstance(h, (int, float)) else np.nan)
+                metal = dominant_metal(feature.get("all_metal_conc") or {})
+                if metal is not None and metal not in metal_ids:
+                    metal_ids[metal] = len(metals)
+                    metals.append(metal)
+                dominant.append(metal_ids.get(metal, -1))
+        return cls(lon, lat, hmpi, dominant, metals)
+
+    def level(self, z):
+        with self.lock:
+            level = self.levels.get(z)
+            built = level is None
+            if built:
+                level = self.levels[z] = self._aggregate(z)
+            self.levels.move_to_end(z)
+        if built:
+            trim_cluster_cache()
+        return level
+
+    @property
+    def nbytes(self):
+        """Memory held by the points and every level built so far"""
+        with self.lock:
+            levels = sum(level_nbytes(level) for level in self.levels.values())
+        return self.x.nbytes + self.y.nbytes + self.hmpi.nbytes + self.dominant.nbytes + levels
+
+    def drop_levels(self, nbytes):
+        """Drop least recently used levels, never the latest, until about `nbytes` are freed"""
+        with self.lock:
+            while nbytes > 0 and len(self.levels) > 1:
+                _, level = self.levels.popitem(last=False)
+                nbytes -= level_nbytes(level)
+
+    def _aggregate(self, z):
+        g = CLUSTER_GRID
+        side = (1 << z) * g
+        cx = np.clip((self.x * side).astype(np.int64), 0, side - 1)
+        cy = np.clip((self.y * side).astype(np.int64), 0, side - 1)
+        # Tile index first, then the cell within the tile: one tile's
+        # clusters end up contiguous once the keys are sorted
+        tile = (cx // g) * (1 << z) + cy // g
+        keys, inverse, counts = np.unique(tile * g * g + (cx % g) * g + cy % g,
+                                          return_inverse=True, return_counts=True)
+        n = len(keys)
+
+        valid = ~np.isnan(self.hmpi)
+        hmpi_n = np.bincount(inverse[valid], minlength=n)
+        hmpi_sum = np.bincount(inverse[valid], weights=self.hmpi[valid], minlength=n)
+        hmpi_max = np.full(n, -np.inf)
+        np.maximum.at(hmpi_max, inverse[valid], self.hmpi[valid])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            hmpi_mean = hmpi_sum / hmpi_n
+        hmpi_max[hmpi_n == 0] = np.nan
+
+        lon, lat = mercator_lonlat(np.bincount(inverse, weights=self.x, minlength=n) / counts,
+                                   np.bincount(inverse, weights=self.y, minlength=n) / counts)
+
+        dominant = np.full(n, -1)
+        m = len(self.metals)
+        has_metal = self.dominant >= 0
+        if m and has_metal.any():
+            votes = np.bincount(inverse[has_metal] * m + self.dominant[has_metal],
+                                minlength=n * m).reshape(n, m)
+            dominant = np.where(votes.max(axis=1) > 0, votes.argmax(axis=1), -1)
+
+        return {
+            "tile": keys // (g * g),
+            "count": counts,
+            "lon": lon,
+            "lat": lat,
+            "hmpi_mean": hmpi_mean,
+            "hmpi_max": hmpi_max,
+            "dominant": dominant,
+        }
+
+    def tile(self, z, x, y):
+        """Cluster features inside tile (z, x, y)"""
+        level = self.level(z)
+        key = x * (1 << z) + y
+        lo, hi = np.searchsorted(level["tile"], [key, key + 1])
+
+        def num(v):
+            return None if np.isnan(v) else float(v)
+
+        return [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [float(level["lon"][i]), float(level["lat"][i])]},
+                "count": int(level["count"][i]),
+                "HMPI_mean": num(level["hmpi_mean"][i]),
+                "HMPI_max": num(level["hmpi_max"][i]),
+                "dominant_metal": self.metals[level["dominant"][i]] if level["dominant"][i] >= 0 else None,
+            }
+            for i in range(lo, hi)
+        ]
+
+
+def get_cluster_index(doc):
+    """Cluster index of a stored dataset, kept in a small per-worker LRU"""
+    # The feature count is part of the key, so a dataset that is still
+    # being streamed in, or is later extended, gets a fresh index
+    key = (doc["_id"], doc.get("feature_count"))
+    with _cluster_indexes_lock:
+        index = _cluster_indexes.get(key)
+        if index is not None:
+            _cluster_indexes.move_to_end(key)
+            cluster_cache_counters["hits"] += 1
+            return index
+        cluster_cache_counters["misses"] += 1
+
+    index = ClusterIndex.from_batches(iter_feature_batches(doc))
+    with _cluster_indexes_lock:
+        _cluster_indexes[key] = index
+    trim_cluster_cache()
+    return index
+
+
+def trim_cluster_cache():
+    """
+    Keep the cluster cache within CLUSTER_CACHE_SIZE indexes and
+    CLUSTER_CACHE_MAX_BYTES: least recently used indexes go first, then the
+    least recently used levels of the one left. Indexes grow as levels are
+    built, so this runs after every new level as well as every new index.
+    """
+    with _cluster_indexes_lock:
+        while len(_cluster_indexes) > CLUSTER_CACHE_SIZE:
+            _cluster_indexes.popitem(last=False)
+        total = sum(index.nbytes for index in _cluster_indexes.values())
+        while total > CLUSTER_CACHE_MAX_BYTES and len(_cluster_indexes) > 1:
+            _, index = _cluster_indexes.popitem(last=False)
+            total -= index.nbytes
+        if total > CLUSTER_CACHE_MAX_BYTES and _cluster_indexes:
+            next(iter(_cluster_indexes.values())).drop_levels(total - CLUSTER_CACHE_MAX_BYTES)
+
+
+@timed_stage("cache")
+def file_cache_key(file, strategy="half", sheet=None):
+    """Content address of an upload: its bytes, file type and the pipeline parameters"""
+    digest = hashlib.sha256(PIPELINE_FINGERPRINT.encode())
+    digest.update(strategy.encode())
+    if sheet:
+        digest.update(f"sheet={sheet}".encode())
+    digest.update(os.path.splitext(file.filename.lower())[1].encode())
+    for block in iter(lambda: file.stream.read(1 << 20), b""):
+        digest.update(block)
+    file.stream.seek(0)
+    return digest.hexdigest()
+
+
+@timed_stage("cache")
+def get_cached_result(cache_key):
+    """Return the stored samples document for a previously processed upload, or None"""
+    entry = result_cache.find_one_and_update(
+        {"_id": cache_key},
+        {"$set": {"last_used_at": datetime.utcnow()}}
+    )
+    # Appends copy a dataset handed out more than once instead of changing it.
+    # One being appended to in place is not handed out: it is about to change.
+    doc = samples_collection.find_one_and_update(
+        {"_id": entry["file_id"], "append_started_at": None},
+        {"$set": {"shared": True}},
+    ) if entry else None
+    if doc is None:
+        if entry:
+            # The result was deleted behind the cache's back, or is being appended to
+            result_cache.delete_one({"_id": cache_key})
+        result_cache_counters["misses"] += 1
+        return None
+    result_cache_counters["hits"] += 1
+    doc.setdefault("row_count", entry.get("row_count"))
+    return doc
+
+
+@timed_stage("cache")
+def store_cached_result(cache_key, file_id, row_count):
+    """Remember the samples document for an upload, evicting least recently used entries"""
+    now = datetime.utcnow()
+    result_cache.update_one(
+        {"_id": cache_key},
+        {"$set": {"file_id": file_id, "row_count": row_count, "created_at": now, "last_used_at": now}},
+        upsert=True
+    )
+    excess = result_cache.estimated_document_count() - RESULT_CACHE_MAX_ENTRIES
+    if excess > 0:
+        stale = result_cache.find({}, {"_id": 1}).sort("last_used_at", 1).limit(excess)
+        result_cache.delete_many({"_id": {"$in": [e["_id"] for e in stale]}})
+
+
+def get_job_pool():
+    """Create the job process pool on first use, i.e. inside each gunicorn worker after fork"""
+    global _job_pool
+    with _job_pool_lock:
+        if _job_pool is None:
+            # spawn rather than fork: the worker already runs MongoDB client threads
+            _job_pool = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _job_pool
+
+
+def discard_job_pool(pool):
+    """Drop a broken pool (e.g. a worker was OOM-killed) so the next job starts a fresh one"""
+    global _job_pool
+    with _job_pool_lock:
+        if _job_pool is pool:
+            _job_pool = None
+    pool.shutdown(wait=False)
+
+
+def submit_to_job_pool(fn, *args):
+    pool = get_job_pool()
+    try:
+        return pool.submit(fn, *args)
+    except BrokenProcessPool:
+        discard_job_pool(pool)
+        return get_job_pool().submit(fn, *args)
+
+
+def submit_process_job(file, doc_fields=None, job_fields=None, sheet=None):
+    """
+    Queue an upload for background processing and return its job id.
+    Returns None when JOB_MAX_QUEUED jobs are already queued or running in this worker.
+    """
+    if not _job_slots.acquire(blocking=False):
+        return None
+    try:
+        job_id = str(uuid.uuid4())
+        now = datetime.utcnow()
+        job = {"_id": job_id, "file_name": file.filename, "created_at": now, "updated_at": now, **(job_fields or {})}
+
+        cache_key = file_cache_key(file, sheet=sheet)
+        cached = get_cached_result(cache_key)
+        if cached is not None:
+            jobs_collection.insert_one({**job, "status": "done", "file_id": cached["_id"], "row_count": cached["row_count"]})
+            _job_slots.release()
+            return job_id
+
+        data = file.read()
+        jobs_collection.insert_one({**job, "status": "queued"})
+        future = submit_to_job_pool(run_pipeline_on_bytes, data, file.filename, sheet)
+    except Exception:
+        _job_slots.release()
+        raise
+    future.add_done_callback(lambda f: finish_process_job(job_id, cache_key, doc_fields, f))
+    return job_id
+
+
+def finish_process_job(job_id, cache_key, doc_fields, future):
+    """Store a finished job's features and record the outcome on its job document"""
+    try:
+        features, row_count, fields = future.result()
+        doc_id = str(uuid.uuid4())
+        store_features(samples_collection, {
+            "_id": doc_id,
+            "created_at": datetime.utcnow(),
+            "row_count": row_count,
+            **fields,
+            **(doc_fields or {}),
+        }, features)
+        store_cached_result(cache_key, doc_id, row_count)
+        update = {"status": "done", "file_id": doc_id, "row_count": row_count}
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        update = {"status": "failed", "error": str(e)}
+    finally:
+        _job_slots.release()
+    update["updated_at"] = datetime.utcnow()
+    jobs_collection.update_one({"_id": job_id}, {"$set": update})
+
+
+def process_upload_batch(files, sheet=None):
+    """
+    Run the pipeline for many uploads at once, spreading the files over the
+    process pool. Returns one result per file, in order: either
+    {"file_name", "GeoJSON", "row_count"} plus the cached "dataset", or
+    "fields" and the "cache_key" to store a new one under; or
+    {"file_name", "error"}.
+
+    Every file in the pool holds one of the JOB_MAX_QUEUED job slots, as
+    async jobs do. Returns None, having run nothing, when the slots for the
+    batch's uncached files (or all JOB_MAX_QUEUED, for a larger batch) are
+    not free; a larger batch then waits for its own files to free theirs.
+    """
+    results, misses = [], []
+    for file in files:
+        result = {"file_name": file.filename}
+        results.append(result)
+        if not allowed_file(file.filename):
+            result["error"] = "Unsupported file format"
+            continue
+        cache_key = file_cache_key(file, sheet=sheet)
+        cached = get_cached_result(cache_key)
+        if cached is not None:
+            result["GeoJSON"] = load_features(cached)
+            result["row_count"] = cached["row_count"]
+            result["dataset"] = cached
+            continue
+        result["cache_key"] = cache_key
+        misses.append((result, file))
+
+    held, needed = 0, min(len(misses), JOB_MAX_QUEUED)
+    while held < needed and _job_slots.acquire(blocking=False):
+        held += 1
+    if held < needed:
+        for _ in range(held):
+            _job_slots.release()
+        return None
+
+    pending = []
+    try:
+        for result, file in misses:
+            if not held:
+                _job_slots.acquire()
+                held += 1
+            future = submit_to_job_pool(run_pipeline_on_bytes, file.read(), file.filename, sheet)
+            future.add_done_callback(lambda f: _job_slots.release())
+            held -= 1
+            pending.append((result, future))
+    except Exception:
+        for _ in range(held):
+            _job_slots.release()
+        raise
+
+    for result, future in pending:
+        try:
+            result["GeoJSON"], result["row_count"], result["fields"] = future.result()
+        except Exception as e:
+            result["error"] = str(e)
+    return results
+
+
+def store_batch_datasets(results, doc_fields=None):
+    """
+    Store the datasets of the process_upload_batch results the cache did not
+    have, with one insert_many, and cache them. Afterwards every result
+    carries its "dataset".
+    """
+    new = [r for r in results if "dataset" not in r]
+    now = datetime.utcnow()
+    docs = [{"_id": str(uuid.uuid4()), "created_at": now, "row_count": r["row_count"], **r.pop("fields"),
+             **(doc_fields or {})}
+            for r in new]
+    store_features_many(samples_collection, docs, [r["GeoJSON"] for r in new])
+    for r, doc in zip(new, docs):
+        store_cached_result(r.pop("cache_key"), doc["_id"], doc["row_count"])
+        r["dataset"] = doc
+
+
+def worker_status():
+    return {
+        "pid": os.getpid(),
+        "started_at": process_started_at,
+        "first_request_at": first_request_at,
+        "uptime_s": round(time.time() - process_started_at, 3),
+    }
+
+
+def init_app(app):
+    """Install the JSON provider and the request hooks on a Flask app"""
+    if JSON_PROVIDER == "orjson" and orjson is not None:
+        app.json = FastJSONProvider(app)
+    app.before_request(start_request_timer)
+    app.before_request(ensure_indexes)
+    # after_request hooks run last-registered first: compress, then time
+    app.after_request(record_request_metrics)
+    app.after_request(compress_response)
@@ -0,0 +1,48 @@
+"""
+Shared fixtures. Both apps run against mongomock, so the tests need no
+MongoDB server.
+"""
+import io
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "AquaScan_prototype"), os.path.join(ROOT, "benchmarks")]
+
+import hmpi_server  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """A fresh mongomock database behind every collection hmpi_server uses"""
+    mongomock = pytest.importorskip("mongomock")
+    db = mongomock.MongoClient().aquascan_test
+    monkeypatch.setattr(hmpi_server, "db", db)
+    for name in ("samples_collection", "result_cache", "feature_chunks", "feature_points", "jobs_collection"):
+        monkeypatch.setattr(hmpi_server, name, db[getattr(hmpi_server, name).name])
+    return db
+
+
+@pytest.fixture
+def app_client(db):
+    import app
+    return app.app.test_client()
+
+
+@pytest.fixture
+def proj_client(db):
+    import proj
+    return proj.app.test_client()
+
+
+def new_user(db):
+    return db.users.insert_one({"name": "test", "email": "test@example.com",
+                                "upload_count": 0, "token_balance": 0}).inserted_id
+
+
+def post_file(client, url, data, filename="samples.csv", **fields):
+    """POST `data` as the multipart "file" field, as the frontend does"""
+    return client.post(url, data={"file": (io.BytesIO(data), filename), **fields},
+                       content_type="multipart/form-data")
@@ -0,0 +1,111 @@
+"""
+POST /datasets/<file_id>/append against both apps.
+"""
+import pytest
+from pymongo.errors import OperationFailure
+
+import hmpi_server
+from conftest import new_user, post_file
+from synthetic import make_groundwater_dataset
+
+
+def csv_bytes(rows, seed):
+    return make_groundwater_dataset(rows, seed=seed).to_csv(index=False).encode()
+
+
+def test_append_then_reload_matches_processing_the_whole_file(app_client):
+    df = make_groundwater_dataset(52, seed=5)
+    # The dataset's 'half' fill and unit decisions come from the rows processed
+    # first, so those hold every metal's minimum and maximum
+    metals = [col for col in df.columns if col.endswith("_conc")]
+    extremes = set(df[metals].idxmin()) | set(df[metals].idxmax())
+    df = df.loc[sorted(extremes) + [i for i in df.index if i not in extremes]]
+    head, tail = df.iloc[:40], df.iloc[40:]
+    whole = post_file(app_client, "/process", df.to_csv(index=False).encode()).get_json()
+
+    file_id = post_file(app_client, "/process", head.to_csv(index=False).encode()).get_json()["file_id"]
+    assert post_file(app_client, f"/datasets/{file_id}/append", tail.to_csv(index=False).encode()).status_code == 200
+
+    assert app_client.get(f"/geojson/{file_id}").get_json() == whole["GeoJSON"]
+    assert (app_client.get(f"/download/{file_id}?format=csv").get_data()
+            == app_client.get(f"/download/{whole['file_id']}?format=csv").get_data())
+    appended, expected = (app_client.get(f"/stats/{i}").get_json()["hmpi"] for i in (file_id, whole["file_id"]))
+    assert appended["count"] == expected["count"]
+    assert appended["mean"] == pytest.approx(expected["mean"])
+
+
+def test_append_to_shared_dataset_leaves_it_unchanged(app_client):
+    original, extra = csv_bytes(40, seed=1), csv_bytes(12, seed=2)
+    file_id = post_file(app_client, "/process", original).get_json()["file_id"]
+    # The same file again is a result cache hit: both clients now hold file_id
+    assert post_file(app_client, "/process", original).get_json()["file_id"] == file_id
+
+    response = post_file(app_client, f"/datasets/{file_id}/append", extra)
+
+    assert response.status_code == 200
+    copy_id = response.get_json()["file_id"]
+    assert copy_id != file_id
+    assert len(app_client.get(f"/geojson/{file_id}").get_json()) == 40
+    assert app_client.get(f"/stats/{file_id}").get_json()["hmpi"]["count"] <= 40
+    assert len(app_client.get(f"/geojson/{copy_id}").get_json()) == 52
+    # Re-uploading the original file still returns the original dataset
+    assert post_file(app_client, "/process", original).get_json()["file_id"] == file_id
+
+
+def test_append_to_unshared_dataset_extends_it_in_place(app_client):
+    file_id = post_file(app_client, "/process", csv_bytes(40, seed=1)).get_json()["file_id"]
+
+    response = post_file(app_client, f"/datasets/{file_id}/append", csv_bytes(12, seed=2))
+
+    assert response.get_json()["file_id"] == file_id
+    assert len(app_client.get(f"/geojson/{file_id}").get_json()) == 52
+
+
+def test_append_by_another_user_goes_to_their_copy(db, proj_client):
+    owner, other = str(new_user(db)), str(new_user(db))
+    original = csv_bytes(40, seed=1)
+    file_id = post_file(proj_client, "/process", original, user_id=owner).get_json()["file_id"]
+    assert post_file(proj_client, "/process", original, user_id=other).get_json()["file_id"] == file_id
+
+    response = post_file(proj_client, f"/datasets/{file_id}/append", csv_bytes(12, seed=2), user_id=other)
+
+    assert response.status_code == 200
+    copy_id = response.get_json()["file_id"]
+    assert copy_id != file_id
+    assert str(db.samples.find_one({"_id": copy_id})["user_id"]) == other
+    assert len(proj_client.get(f"/geojson/{file_id}").get_json()) == 40
+    assert len(proj_client.get(f"/geojson/{copy_id}").get_json()) == 52
+
+
+def test_features_past_feature_count_are_not_served(db, app_client):
+    file_id = post_file(app_client, "/process", csv_bytes(40, seed=1)).get_json()["file_id"]
+    doc = db.samples.find_one({"_id": file_id})
+    # What an append in progress has stored before it updates feature_count
+    hmpi_server.append_feature_chunks(doc, hmpi_server.load_features(doc)[:12])
+
+    assert len(app_client.get(f"/geojson/{file_id}").get_json()) == 40
+    assert len(app_client.get(f"/geojson/{file_id}?limit=100").get_json()["GeoJSON"]) == 40
+    assert len(app_client.get(f"/download/{file_id}?format=ndjson").get_data().splitlines()) == 40
+
+
+def test_failed_append_removes_what_it_stored(db, app_client, monkeypatch):
+    file_id = post_file(app_client, "/process", csv_bytes(40, seed=1)).get_json()["file_id"]
+    points = db.feature_points.count_documents({"dataset_id": file_id})
+    update_one = hmpi_server.samples_collection.update_one
+
+    def failing_update(query, update, *args, **kwargs):
+        if "feature_count" in update.get("$set", {}):
+            raise OperationFailure("write failed")
+        return update_one(query, update, *args, **kwargs)
+
+    with monkeypatch.context() as patched:
+        patched.setattr(hmpi_server.samples_collection, "update_one", failing_update)
+        assert post_file(app_client, f"/datasets/{file_id}/append", csv_bytes(12, seed=2)).status_code == 500
+
+    chunks = db.feature_chunks.find({"dataset_id": file_id})
+    assert sum(len(chunk["features"]) for chunk in chunks) == 40
+    assert db.feature_points.count_documents({"dataset_id": file_id}) == points
+    # The lock was released: the next append goes through
+    response = post_file(app_client, f"/datasets/{file_id}/append", csv_bytes(12, seed=2))
+    assert response.get_json()["file_id"] == file_id
+    assert len(app_client.get(f"/geojson/{file_id}").get_json()) == 52
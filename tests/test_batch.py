@@ -0,0 +1,44 @@
+"""
+POST /upload/batch and the worker's job slots (JOB_MAX_QUEUED).
+"""
+import io
+import threading
+
+import pytest
+
+import hmpi_server
+from synthetic import make_groundwater_dataset
+
+
+@pytest.fixture
+def job_slots(monkeypatch):
+    monkeypatch.setattr(hmpi_server, "JOB_MAX_QUEUED", 2)
+    monkeypatch.setattr(hmpi_server, "_job_slots", threading.BoundedSemaphore(2))
+    return hmpi_server._job_slots
+
+
+def post_batch(client, seeds):
+    files = [(io.BytesIO(make_groundwater_dataset(20, seed=seed).to_csv(index=False).encode()), f"{seed}.csv")
+             for seed in seeds]
+    return client.post("/upload/batch", data={"files": files}, content_type="multipart/form-data")
+
+
+def test_batch_without_free_job_slots_is_refused(app_client, job_slots):
+    job_slots.acquire()
+
+    response = post_batch(app_client, [1, 2])
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"]
+    job_slots.release()
+    # The slot the batch could take was given back
+    assert job_slots.acquire(blocking=False) and job_slots.acquire(blocking=False)
+
+
+def test_batch_larger_than_the_job_slots_runs_and_frees_them(app_client, job_slots):
+    response = post_batch(app_client, [1, 2, 3])
+
+    assert response.status_code == 201
+    assert [r.get("error") for r in response.get_json()["results"]] == [None] * 3
+    # Slots are given back by the futures' done callbacks, possibly just after the response
+    assert job_slots.acquire(timeout=5) and job_slots.acquire(timeout=5)
@@ -0,0 +1,16 @@
+"""
+GET /metrics: every series is labelled with the worker that produced it.
+"""
+import os
+import re
+
+
+def test_every_series_has_the_worker_label(app_client):
+    app_client.get("/health")
+
+    body = app_client.get("/metrics").get_data(as_text=True)
+
+    samples = [line for line in body.splitlines() if line and not line.startswith("#")]
+    assert samples
+    worker = f'worker="{os.getpid()}"'
+    assert all(re.search(r"\{.*" + worker + r".*\} ", line) for line in samples)
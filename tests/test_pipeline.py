@@ -0,0 +1,19 @@
+"""
+hmpi_pipeline without the apps or MongoDB.
+"""
+import pytest
+
+from hmpi_pipeline import dataframe_pipeline_params, run_lean_pipeline
+from synthetic import make_groundwater_dataset
+
+
+@pytest.mark.parametrize("strategy", ["half", "zero", "mean", "median"])
+def test_run_lean_pipeline_returns_the_dataframe_params(strategy):
+    # The synthetic data has missing readings in every metal column
+    df = make_groundwater_dataset(200, seed=3)
+
+    df_hmpi, merged_cols, params = run_lean_pipeline(df, strategy=strategy, return_params=True)
+
+    assert params == dataframe_pipeline_params(df, strategy=strategy)
+    expected, _ = run_lean_pipeline(df, strategy=strategy)
+    assert df_hmpi.equals(expected)
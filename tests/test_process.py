@@ -0,0 +1,34 @@
+"""
+POST /process: the streamed CSV path (?stream=1) against single-pass processing.
+"""
+import functools
+import json
+
+import pytest
+
+import hmpi_server
+from conftest import post_file
+from synthetic import make_groundwater_dataset
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    """CSV chunks of 7 rows and stored chunks of 16 features, so both boundaries fall mid-file"""
+    monkeypatch.setattr(hmpi_server, "iter_csv_feature_chunks",
+                        functools.partial(hmpi_server.iter_csv_feature_chunks, chunksize=7))
+    monkeypatch.setattr(hmpi_server, "FEATURE_CHUNK_SIZE", 16)
+
+
+def test_streamed_csv_matches_single_pass(app_client, small_chunks):
+    # Missing readings make the 'half' fill and the unit decision depend on the whole file
+    data = make_groundwater_dataset(100, seed=4).to_csv(index=False).encode()
+    single = post_file(app_client, "/process", data).get_json()
+
+    response = post_file(app_client, "/process?stream=1", data)
+    streamed = json.loads(response.get_data())
+
+    assert streamed["file_id"] != single["file_id"]
+    assert streamed["GeoJSON"] == single["GeoJSON"]
+    # What was stored matches too, chunk boundaries and all
+    assert (app_client.get(f"/geojson/{streamed['file_id']}").get_json()
+            == app_client.get(f"/geojson/{single['file_id']}").get_json())
@@ -0,0 +1,64 @@
+"""
+GET /geojson/<file_id>/query. mongomock has no geo operators, so the
+location filter is dropped before the points are read; what is tested is
+the parameter checks, the limit and the error responses.
+"""
+import pytest
+from pymongo.errors import OperationFailure
+
+import hmpi_server
+from conftest import post_file
+from synthetic import make_groundwater_dataset
+
+
+@pytest.fixture
+def file_id(app_client):
+    data = make_groundwater_dataset(30, seed=1).to_csv(index=False).encode()
+    return post_file(app_client, "/process", data).get_json()["file_id"]
+
+
+@pytest.fixture
+def points_without_geo(db, monkeypatch):
+    find = db.feature_points.find
+
+    def find_ignoring_location(query, *args, **kwargs):
+        return find({k: v for k, v in query.items() if k != "location"}, *args, **kwargs)
+
+    monkeypatch.setattr(hmpi_server.feature_points, "find", find_ignoring_location)
+
+
+@pytest.mark.parametrize("radius", ["nan", "inf", "-inf", "0", "-5"])
+def test_radius_must_be_positive_and_finite(app_client, file_id, radius):
+    response = app_client.get(f"/geojson/{file_id}/query?near=76.2,10.5&radius={radius}")
+
+    assert response.status_code == 400
+    assert "radius" in response.get_json()["error"]
+
+
+@pytest.mark.parametrize("min_hmpi", ["nan", "inf", "-inf"])
+def test_min_hmpi_must_be_finite(app_client, file_id, min_hmpi):
+    response = app_client.get(f"/geojson/{file_id}/query?bbox=-180,-90,180,90&min_hmpi={min_hmpi}")
+
+    assert response.status_code == 400
+    assert "min_hmpi" in response.get_json()["error"]
+
+
+def test_truncated_only_when_points_were_left_out(app_client, file_id, points_without_geo):
+    total = app_client.get(f"/geojson/{file_id}/query?bbox=-180,-90,180,90").get_json()["count"]
+
+    exact = app_client.get(f"/geojson/{file_id}/query?bbox=-180,-90,180,90&limit={total}").get_json()
+    short = app_client.get(f"/geojson/{file_id}/query?bbox=-180,-90,180,90&limit={total - 1}").get_json()
+
+    assert (exact["count"], exact["truncated"]) == (total, False)
+    assert (short["count"], short["truncated"]) == (total - 1, True)
+
+
+def test_failed_point_query_returns_json_error(app_client, file_id, monkeypatch):
+    def rejected(*args, **kwargs):
+        raise OperationFailure("Can't extract geo keys")
+
+    monkeypatch.setattr(hmpi_server.feature_points, "find", rejected)
+    response = app_client.get(f"/geojson/{file_id}/query?near=76.2,10.5&radius=500")
+
+    assert response.status_code == 400
+    assert "geo keys" in response.get_json()["error"]
@@ -0,0 +1,51 @@
+"""
+GET /tiles below CLUSTER_MAX_ZOOM and the per-worker cluster index cache.
+"""
+import pytest
+
+import hmpi_server
+from conftest import post_file
+from synthetic import make_groundwater_dataset
+
+
+@pytest.fixture
+def cluster_cache(monkeypatch):
+    monkeypatch.setattr(hmpi_server, "_cluster_indexes", type(hmpi_server._cluster_indexes)())
+    return hmpi_server._cluster_indexes
+
+
+def process(client, rows, seed):
+    data = make_groundwater_dataset(rows, seed=seed).to_csv(index=False).encode()
+    return post_file(client, "/process", data).get_json()["file_id"]
+
+
+def tile(client, file_id, z):
+    response = client.get(f"/tiles/{file_id}/{z}/0/0")
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_cluster_cache_stays_within_its_byte_budget(app_client, cluster_cache, monkeypatch):
+    first, second = process(app_client, 200, seed=1), process(app_client, 200, seed=2)
+    tile(app_client, first, 0)
+    one_level = next(iter(cluster_cache.values())).nbytes
+    monkeypatch.setattr(hmpi_server, "CLUSTER_CACHE_MAX_BYTES", one_level)
+
+    tile(app_client, first, 1)
+    tile(app_client, second, 0)
+
+    # Only the most recent dataset is kept, with its latest level
+    (index,) = cluster_cache.values()
+    assert list(index.levels) == [0]
+    assert sum(i.nbytes for i in cluster_cache.values()) <= one_level
+
+
+def test_dropped_levels_are_rebuilt_the_same(app_client, cluster_cache, monkeypatch):
+    file_id = process(app_client, 200, seed=1)
+    expected = [tile(app_client, file_id, z) for z in range(3)]
+    cluster_cache.clear()
+    monkeypatch.setattr(hmpi_server, "CLUSTER_CACHE_MAX_BYTES", 1)
+
+    assert [tile(app_client, file_id, z) for z in range(3)] == expected
+    (index,) = cluster_cache.values()
+    assert list(index.levels) == [2]
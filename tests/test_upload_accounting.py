@@ -0,0 +1,77 @@
+"""
+Upload accounting under concurrency: parallel uploads for one user must
+leave users.upload_count equal to the uploads actually stored.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import proj
+from conftest import new_user, post_file
+
+SAMPLE_CSV = b"Sample_ID,Latitude,Longitude,Pb,Cd\n1,10.5,76.2,0.02,0.001\n2,10.6,76.3,0.01,\n"
+THREADS = 8
+PER_THREAD = 10
+
+
+def run_parallel(fn, total):
+    with ThreadPoolExecutor(THREADS) as pool:
+        return list(pool.map(fn, range(total)))
+
+
+def test_record_uploads_counts_every_parallel_upload(db):
+    user_id = new_user(db)
+
+    def upload(_):
+        proj.cached_user_entry(user_id)
+        db.uploads.insert_one({"user_id": user_id, "created_at": datetime.utcnow(), "row_count": 2})
+        proj.record_uploads(user_id)
+
+    run_parallel(upload, THREADS * PER_THREAD)
+
+    stored = db.uploads.count_documents({"user_id": user_id})
+    assert stored == THREADS * PER_THREAD
+    assert db.users.find_one({"_id": user_id})["upload_count"] == stored
+
+
+def test_record_uploads_refreshes_cached_user(db):
+    user_id = new_user(db)
+    proj.cached_user_entry(user_id)
+
+    assert proj.record_uploads(user_id, 3)["upload_count"] == 3
+    assert proj.cached_user_entry(user_id)["user"]["upload_count"] == 3
+
+
+def test_parallel_upload_requests_count_every_upload(db, proj_client):
+    user_id = new_user(db)
+
+    def post(_):
+        return post_file(proj_client, "/upload", SAMPLE_CSV, user_id=str(user_id)).status_code
+
+    statuses = run_parallel(post, THREADS * PER_THREAD)
+
+    assert statuses == [201] * (THREADS * PER_THREAD)
+    stored = db.uploads.count_documents({"user_id": user_id})
+    assert stored == THREADS * PER_THREAD
+    assert db.users.find_one({"_id": user_id})["upload_count"] == stored
+
+
+def test_user_cache_keeps_at_most_max_entries(db, monkeypatch):
+    monkeypatch.setattr(proj, "_user_cache", type(proj._user_cache)())
+    monkeypatch.setattr(proj, "USER_CACHE_MAX_ENTRIES", 3)
+    user_ids = [new_user(db) for _ in range(5)]
+
+    for user_id in user_ids:
+        proj.cached_user_entry(user_id)
+
+    assert list(proj._user_cache) == user_ids[2:]
+
+
+def test_user_cache_drops_expired_entries_on_insert(db, monkeypatch):
+    monkeypatch.setattr(proj, "_user_cache", type(proj._user_cache)())
+    monkeypatch.setattr(proj, "USER_CACHE_TTL", 0)
+    first, second = new_user(db), new_user(db)
+
+    proj.cached_user_entry(first)
+    proj.cached_user_entry(second)
+
+    assert list(proj._user_cache) == [second]